@@ -1,21 +1,58 @@
 import pprint
 import sys
 import time
+import socket
 import struct
 import asyncio
 import argparse
+import ipaddress
+import math
 
 CONFIG_MSG_SIZE = 2
 
+# Protocol v2, see src/tcp_server.py
+HELLO_MARKER = b'\xf2'
+HELLO_FMT = '!BBBH'
+CONFIG_V2_FMT = '!BBHHHB'
+HEADER_V2_FMT = '!BBIdHH'
+DB_RANGE_FMT = '!hh'
+FLAG_NO_ACK = 0x01
+
+# Payload encodings, see src/encoding.py
+ENCODING_FLOAT32 = 0
+ENCODING_INT16 = 1
+ENCODING_UINT8 = 2
+ENCODING_DELTA = 3
+ENCODINGS = {
+    'float32': ENCODING_FLOAT32,
+    'int16': ENCODING_INT16,
+    'uint8': ENCODING_UINT8,
+    'delta': ENCODING_DELTA,
+}
+
+# UDP transport, see src/udp_transport.py
+UDP_MAGIC = b'FT'
+UDP_VERSION = 1
+UDP_MSG_FRAME = 0
+UDP_MSG_CONFIG = 1
+UDP_MSG_CONFIG_REQUEST = 2
+UDP_HEADER_FMT = '!2sBB'
+UDP_FRAME_HEADER_FMT = UDP_HEADER_FMT + 'IdH'
+UDP_CONFIG_FMT = UDP_HEADER_FMT + 'HH4sH'
+
 class FFTClient:
 
     def __init__(self, reader, writer):
         self._reader = reader
         self._writer = writer
+        self._next_sequence = None
+        self._levels = None
 
         self.last_read_duration_ms = 0
         self.last_sample_time_ms = 0
         self.last_sample_tstamp = 0
+        self.last_frame_tstamp = 0
+        self.lost_frames = 0
 
         self.config = {}
         
@@ -28,12 +65,18 @@ class FFTClient:
         self._writer.write(b'1')    
         await self._writer.drain()
 
-    async def init_config(self):
+    async def init_config(self, version = 1, frames_per_message = 1, ack = True, encoding = ENCODING_FLOAT32):
         data = await self._read_data(CONFIG_MSG_SIZE)
-        await self._acknowledge()
-        
+        if version == 2:
+            await self._init_config_v2(frames_per_message, ack, encoding)
+            return
+
         sample_rate = struct.unpack("!b", data[0:1])[0]
         frequency_bands_count = struct.unpack("!b", data[1:2])[0]
+        if frequency_bands_count <= 0:
+            raise ConnectionError("The server has more than 127 frequency bands, use --protocol 2")
+
+        await self._acknowledge()
 
         frames_count = 1
         buffer_size = frames_count * frequency_bands_count * struct.calcsize('!f')
@@ -46,8 +89,44 @@ class FFTClient:
         config['period_ms'] = 1000 // sample_rate # The period of each data message in ms
         config['fft_unpack_fmt'] = f"!{frequency_bands_count}f" # The format for unpacking the binary data 
         config['buffer_length_ms'] = frames_count * config['period_ms'] # The length of each audio sampled analized in ms
+        config['version'] = 1
+        config['ack'] = True
         
         self.config = config
+
+    async def _init_config_v2(self, frames_per_message, ack, encoding):
+        '''
+        Answer the v1 config with a v2 hello instead of the ACK byte.
+        The server replies with the v2 config, the data messages then carry a header
+        with a sequence number and a timestamp and can batch several frames
+        '''
+        flags = 0 if ack else FLAG_NO_ACK
+        self._writer.write(HELLO_MARKER + struct.pack(HELLO_FMT, 2, flags, encoding, frames_per_message))
+        await self._writer.drain()
+
+        data = await self._read_data(struct.calcsize(CONFIG_V2_FMT))
+        version, flags, sample_rate, frequency_bands_count, frames_count, encoding = struct.unpack(CONFIG_V2_FMT, data)
+
+        db_range = None
+        if encoding in (ENCODING_UINT8, ENCODING_DELTA):
+            # Quantized levels, 0-255 maps to this dB range
+            low, high = struct.unpack(DB_RANGE_FMT, await self._read_data(struct.calcsize(DB_RANGE_FMT)))
+            db_range = (low / 100, high / 100)
+
+        config = {}
+        config['samplerate'] = sample_rate
+        config['frames_count'] = frames_count # Frames per data message
+        config['frequency_bands_count'] = frequency_bands_count
+        config['buffer_size'] = None # Depends on the encoding, delta frames have a variable size
+        config['period_ms'] = 1000 // sample_rate
+        config['fft_unpack_fmt'] = f"!{frequency_bands_count}f"
+        config['buffer_length_ms'] = frames_count * config['period_ms']
+        config['version'] = version
+        config['ack'] = not (flags & FLAG_NO_ACK)
+        config['encoding'] = encoding
+        config['db_range'] = db_range
+
+        self.config = config
         
     async def _read_data(self, data_len):
         now = time.time()
@@ -74,6 +153,76 @@ class FFTClient:
         self.last_read_duration_ms = (time.time() - now) * 1000
         return fft_data
 
+    async def read_fft_frames(self):
+        '''Read one data message, returns the amplitudes of every frame in it'''
+        if self.config['version'] == 1:
+            return [await self.read_fft_data()]
+
+        now = time.time()
+
+        if self.last_sample_tstamp > 0:
+            self.last_sample_time_ms = (now - self.last_sample_tstamp) * 1000
+
+        self.last_sample_tstamp = now
+
+        header_size = struct.calcsize(HEADER_V2_FMT)
+        header = await asyncio.wait_for(self._read_data(header_size), timeout=0.05 * self.config['frames_count'])
+        _, _, sequence, timestamp, frequency_bands_count, frames_count = struct.unpack(HEADER_V2_FMT, header)
+
+        frames = []
+        for _ in range(frames_count):
+            frames.append(await self._read_frame_v2(frequency_bands_count))
+
+        if self.config['ack']:
+            await self._acknowledge()
+
+        if self._next_sequence is not None:
+            gap = (sequence - self._next_sequence) & 0xFFFFFFFF
+            if gap < 0x80000000:
+                self.lost_frames += gap
+
+        self._next_sequence = (sequence + frames_count) & 0xFFFFFFFF
+        self.last_frame_tstamp = timestamp
+
+        self.last_read_duration_ms = (time.time() - now) * 1000
+        return frames
+
+    async def _read_frame_v2(self, frequency_bands_count):
+        encoding = self.config['encoding']
+
+        if encoding == ENCODING_FLOAT32:
+            data = await self._read_data(frequency_bands_count * 4)
+            return struct.unpack(f"!{frequency_bands_count}f", data)
+
+        if encoding == ENCODING_INT16:
+            data = await self._read_data(frequency_bands_count * 2)
+            return tuple(-math.inf if v == -32768 else v / 100 for v in struct.unpack(f"!{frequency_bands_count}h", data))
+
+        if encoding == ENCODING_UINT8:
+            levels = list(await self._read_data(frequency_bands_count))
+        else:
+            levels = await self._read_delta_frame(frequency_bands_count)
+
+        low, high = self.config['db_range']
+        return tuple(low + level * (high - low) / 255 for level in levels)
+
+    async def _read_delta_frame(self, frequency_bands_count):
+        '''
+        A keyframe carries every level, a delta frame a bitmask (MSB first) of the bands
+        that changed since the previous frame followed by their levels
+        '''
+        frame_type = (await self._read_data(1))[0]
+        if frame_type == 0:
+            self._levels = list(await self._read_data(frequency_bands_count))
+            return self._levels
+
+        mask = await self._read_data((frequency_bands_count + 7) // 8)
+        changed = [i for i in range(frequency_bands_count) if mask[i // 8] & (0x80 >> (i % 8))]
+        values = await self._read_data(len(changed))
+        for i, value in zip(changed, values):
+            self._levels[i] = value
+        return list(self._levels)
+
     async def close(self):
         try:
             self.config = {}
@@ -85,19 +234,134 @@ class FFTClient:
             pass
 
 
+class _DatagramQueue(asyncio.DatagramProtocol):
+
+    def __init__(self):
+        self.queue = asyncio.Queue()
+
+    def datagram_received(self, data, addr):
+        self.queue.put_nowait(data)
+
+class UDPFFTClient:
+    '''
+    Receives the FFT frames the server sends over UDP (multicast or broadcast).
+    The config is requested from the server's UDP port, frames carry a sequence number
+    which is used to count the lost frames
+    '''
+
+    def __init__(self, host, port):
+        self._server_address = (host, port)
+        self._transport = None
+        self._protocol = None
+        self._last_sequence = None
+
+        self.last_read_duration_ms = 0
+        self.last_sample_time_ms = 0
+        self.last_sample_tstamp = 0
+        self.last_frame_tstamp = 0
+        self.lost_frames = 0
+
+        self.config = {}
+
+    async def init_config(self):
+        loop = asyncio.get_running_loop()
+
+        transport, protocol = await loop.create_datagram_endpoint(_DatagramQueue, remote_addr=self._server_address)
+        try:
+            transport.sendto(struct.pack(UDP_HEADER_FMT, UDP_MAGIC, UDP_VERSION, UDP_MSG_CONFIG_REQUEST))
+            data = await protocol.queue.get()
+        finally:
+            transport.close()
+
+        magic, version, message_type, sample_rate, frequency_bands_count, group, group_port = struct.unpack(UDP_CONFIG_FMT, data)
+        if magic != UDP_MAGIC or message_type != UDP_MSG_CONFIG:
+            raise ConnectionError("Invalid config message")
+
+        group = socket.inet_ntoa(group)
+
+        config = {}
+        config['samplerate'] = sample_rate
+        config['frames_count'] = 1
+        config['frequency_bands_count'] = frequency_bands_count
+        config['buffer_size'] = frequency_bands_count * struct.calcsize('!f')
+        config['period_ms'] = 1000 // sample_rate
+        config['fft_unpack_fmt'] = f"!{frequency_bands_count}f"
+        config['buffer_length_ms'] = config['period_ms']
+        config['udp_group'] = f"{group}:{group_port}"
+        self.config = config
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('', group_port))
+        if ipaddress.ip_address(group).is_multicast:
+            membership = socket.inet_aton(group) + socket.inet_aton('0.0.0.0')
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+
+        self._transport, self._protocol = await loop.create_datagram_endpoint(_DatagramQueue, sock=sock)
+
+    async def read_fft_data(self):
+        now = time.time()
+
+        if self.last_sample_tstamp > 0:
+            self.last_sample_time_ms = (now - self.last_sample_tstamp) * 1000
+
+        self.last_sample_tstamp = now
+        header_size = struct.calcsize(UDP_FRAME_HEADER_FMT)
+
+        while True:
+            data = await asyncio.wait_for(self._protocol.queue.get(), timeout=0.05)
+            if len(data) != header_size + self.config['buffer_size']:
+                continue
+
+            magic, _, message_type, sequence, timestamp, _ = struct.unpack_from(UDP_FRAME_HEADER_FMT, data)
+            if magic != UDP_MAGIC or message_type != UDP_MSG_FRAME:
+                continue
+
+            if self._last_sequence is not None:
+                gap = (sequence - self._last_sequence - 1) & 0xFFFFFFFF
+                if gap >= 0x80000000:
+                    # Late or duplicated datagram, a newer frame was already returned
+                    continue
+                self.lost_frames += gap
+
+            self._last_sequence = sequence
+            self.last_frame_tstamp = timestamp
+            break
+
+        fft_data = struct.unpack(self.config["fft_unpack_fmt"], data[header_size:])
+
+        self.last_read_duration_ms = (time.time() - now) * 1000
+        return fft_data
+
+    async def read_fft_frames(self):
+        return [await self.read_fft_data()]
+
+    async def close(self):
+        self.config = {}
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
+
+
 async def main(args):
-    # Connect to the FFT server
-    try:
-        reader, writer = await asyncio.open_connection(args.host, args.port)
-    except ConnectionError as e:
-        print(e)
-        return
+    if args.udp:
+        client = UDPFFTClient(args.host, args.port)
+    else:
+        # Connect to the FFT server
+        try:
+            reader, writer = await asyncio.open_connection(args.host, args.port)
+        except ConnectionError as e:
+            print(e)
+            return
 
-    client = FFTClient(reader, writer)
+        client = FFTClient(reader, writer)
     
     try:
         # Read the config from the server
-        await asyncio.wait_for(client.init_config(), timeout=1)
+        if args.udp:
+            await asyncio.wait_for(client.init_config(), timeout=1)
+        else:
+            await asyncio.wait_for(client.init_config(args.protocol, args.frames, not args.no_ack, ENCODINGS[args.encoding]), timeout=1)
         print('Received config from server:\n', pprint.pformat(client.config))
     except (ConnectionError, asyncio.TimeoutError) as e:
         print(e)
@@ -121,14 +385,15 @@ async def main(args):
             receive_periods.append(client.last_sample_time_ms)
 
         if ((time.time() - last_output_ms) * 1000) >= 1000 and len(receive_periods):
-            print(f"Average receive period: {sum(receive_periods) / len(receive_periods):.2f}ms. Received samples: {received_samples}")
+            lost = f". Lost frames: {client.lost_frames}" if args.udp or args.protocol == 2 else ""
+            print(f"Average receive period: {sum(receive_periods) / len(receive_periods):.2f}ms. Received samples: {received_samples}{lost}")
             receive_periods = []
             last_output_ms = now
 
         # Read the data from server
         try:
-            amplitudes = await client.read_fft_data()
-            received_samples += 1
+            frames = await client.read_fft_frames()
+            received_samples += len(frames)
         except asyncio.TimeoutError:
             continue
         except Exception as e:
@@ -140,7 +405,7 @@ async def main(args):
             continue
         
         # Do something with the amplitudes
-        # print(amplitudes)
+        # print(frames[-1])
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='''
@@ -148,6 +413,11 @@ FFT client implementation
 ''')
     parser.add_argument('--host', default='127.0.0.1', type=str, help='FFT server host. Defaults to "127.0.0.1"')
     parser.add_argument('--port', default=12345, type=int, help='FFT server port. Defaults to 12345')
+    parser.add_argument('--udp', action='store_true', help='Receive the frames over UDP. The server must be started with --udp-target')
+    parser.add_argument('--protocol', default=1, type=int, choices=[1, 2], help='TCP protocol version. Defaults to 1')
+    parser.add_argument('--frames', default=1, type=int, help='Frames per data message, protocol v2 only. Defaults to 1')
+    parser.add_argument('--no-ack', action='store_true', help="Don't acknowledge the data messages, protocol v2 only")
+    parser.add_argument('--encoding', default='float32', choices=list(ENCODINGS.keys()), help='Payload encoding, protocol v2 only. Defaults to float32')
 
     args = parser.parse_args()
     
@@ -2,23 +2,26 @@ import time
 import os
 import argparse
 import sys
-import threading
 import socket
 import queue
 import json
-from dotenv import load_dotenv
-from src import screen
-from src import fft
+import threading
+import numpy as np
 from src import animation_utils
 from src import audio_source
 from src import tcp_server
+from src import streams
+from src import encoding
+from src import shm_ring
+from src import offline
+from src import resample
+from src import bands
+from src import led_sinks
+from src.frame_scheduler import FrameScheduler
 from collections import deque
 
-try:
-    import paho.mqtt.publish as publish
-    mqtt_enabled = True
-except:
-    mqtt_enabled = False
+# pygame (src.screen), pyaudio (src.audio_source) and paho are imported only by the
+# modes that use them, a headless server starts without loading any of them
 
 try:
     from dotenv import load_dotenv
@@ -32,109 +35,182 @@ load_dotenv()
 ANIMATION_FRAMERATE = None
 FFT_SAMPLING_RATE = None
 
-fft_queue = queue.Queue()
-stop_event = threading.Event()
+supervisor = None
 pixels_queue = deque()
+# Band vectors of the last analyzed chunk of every stream that weren't consumed yet
+pending_values = []
+# Shared memory ring of every stream when --shm-name is set
+shm_rings = []
+# --low-latency: band vectors of the first stream forwarded by its thread, waiting for the animation
+animation_values = deque(maxlen=64)
+# --led-output sinks fed with the animation frames
+led_outputs = []
 args = None
 
 last_fft = 0
 last_levels = None
 
 
-def audio_worker():
-    fft.init(fft_queue, not args.disable_emma, args.emma_alpha)
-
-    source = None
-    source_type = None
-    
+def audio_sources():
     if args.file:
-        source = args.file
-        source_type = 'wav'
-    elif args.input_id:
-        source = args.input_id
-        source_type = 'stream'
-        
-    if source is None:
-        print("No audio source provided")
-        raise RuntimeError("No audio source provided")
-
-    # Open the audio source
-    samples_count, framerate, sample_width, channels, wav_generator = audio_source.open_audio(source, source_type, FFT_SAMPLING_RATE)
-    print("Audio framerate (hz):", framerate)
-    
-    if channels > 1:
-        print(f"Audio channels: {channels}. Audio will be converted to mono")
-    else:
-        print("Mono audio")
-        
+        return [(source, 'wav') for source in args.file]
 
-    print("Samples count (bytes):", samples_count)
-    print("Sample width (bits):", sample_width * 8)
-    
-    print("Started audio worker")
-    # Read data
-    for data in wav_generator:
-        fft.analyze(data, samples_count, framerate, sample_width, channels)
-        if stop_event.is_set():
-            wav_generator.close()
-            break
+    if args.input_id:
+        return [(source, 'stream') for source in args.input_id]
+
+    if args.raw:
+        return [(source, 'raw') for source in args.raw]
+
+    if args.synth:
+        return [(source, 'synth') for source in args.synth]
+
+    print("No audio source provided")
+    raise RuntimeError("No audio source provided")
         
-def interpolate(a, b, t):
-    return (1 - t) * a + t * b
+def next_fft_values(stream, timeout = None):
+    '''The audio workers queue one (timestamps, (slices, bands) block) pair per chunk,
+    hand out the (capture timestamp, band vector) rows one at a time'''
+    pending = pending_values[stream]
+    if not len(pending):
+        if timeout:
+            timestamps, levels = supervisor.fft_queues[stream].get(timeout=timeout)
+        else:
+            timestamps, levels = supervisor.fft_queues[stream].get_nowait()
+        pending.extend(zip(timestamps, levels))
+    return pending.popleft()
+
+def shm_ring_name(stream):
+    '''Stream 0 uses --shm-name, stream N uses --shm-name-N'''
+    return args.shm_name if stream == 0 else f"{args.shm_name}-{stream}"
+
+def publish_fft_values(timeout = None, pace = False):
+    '''Forward the next band vector of every stream to its TCP channel and shared memory ring.
+    Returns the (timestamp, values) of the first stream, which drives the animation.
+    With a timeout the first stream is waited on instead of polled. With pace the band
+    vectors of the first stream aren't published before their timestamp, the rows of a
+    played WAV block are heard one hop apart'''
+    first = None
+    for stream in range(len(pending_values)):
+        try:
+            timestamp, stream_values = next_fft_values(stream, timeout if stream == 0 else None)
+        except queue.Empty:
+            continue
+
+        if pace and stream == 0:
+            delay = timestamp - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+        publish_values(stream, timestamp, stream_values)
+
+        if stream == 0:
+            first = (timestamp, stream_values)
+
+    return first
+
+def publish_values(stream, timestamp, values):
+    if not args.disable_server:
+        tcp_server.publish(values, stream, timestamp)
+
+    if shm_rings:
+        shm_rings[stream].write(values, timestamp)
+
+def forward_fft_values(stream):
+    '''--low-latency: publish the band vectors of a stream as soon as they're analyzed
+    instead of once per animation frame'''
+    while True:
+        try:
+            timestamp, values = next_fft_values(stream, 1)
+        except queue.Empty:
+            continue
+
+        publish_values(stream, timestamp, values)
+
+        if stream == 0 and animated():
+            animation_values.append((timestamp, values))
+
+def animated():
+    '''Frames are rasterized for the window or the LED outputs'''
+    return not args.disable_animation or len(led_outputs) > 0
+
+def pending_fft_values():
+    '''Publish everything analyzed since the last animation frame and return the
+    (timestamp, values) of the first stream in order, every one of them is animated'''
+    pending = []
+    if args.low_latency:
+        while len(animation_values):
+            pending.append(animation_values.popleft())
+        return pending
+
+    while True:
+        values = publish_fft_values()
+        if values is None:
+            return pending
+        pending.append(values)
         
 def main(frames_queue = None):
-    global last_fft, last_levels
-
-    values = None
-    
     try:
-        values = fft_queue.get_nowait()
-        
-        if not args.disable_server:
-            tcp_server.data_queue.put(values)
-    except queue.Empty:
-        return
+        if not animated():
+            # Without the animation nothing else paces this loop, block until there is data.
+            # Live audio is published as soon as it's analyzed
+            publish_fft_values(1 / FFT_SAMPLING_RATE, pace=True)
+            return
+
+        pending = pending_fft_values()
     except:
         print("No more audio. Exiting!")
         sys.exit(0)
-        
-    if args.disable_animation:
-        time.sleep(1 / FFT_SAMPLING_RATE)
-        return
+
+    # Frames of late band vectors are already due, the scheduler drops all but the latest one
+    for timestamp, values in pending:
+        rasterize(frames_queue, timestamp, values)
+
+def rasterize(frames_queue, timestamp, values):
+    global last_levels
 
     if last_levels is None:
-        last_levels = [-1] * len(values)
+        last_levels = np.full(len(values), -1)
     
-    current_levels = []
-    for max_amp in values:
-        current_levels.append(animation_utils.get_level(max_amp))
-        
+    current_levels = animation_utils.get_levels(values)
     num_frames = ANIMATION_FRAMERATE // FFT_SAMPLING_RATE
     
     if num_frames == 1:
-        pixels = []
-        for max_amp in values:
-            level = animation_utils.get_level(max_amp)
-            frame = animation_utils.level_to_pixels(level)
-            pixels.append(frame)
-            
-        frames_queue.appendleft(pixels) 
-    else: 
-        frames = []
-        for i in range(num_frames):
-            t = i / (num_frames - 1)
-            interpolated_frame = [interpolate(last_levels[i], current_levels[i], t) for i in range(len(last_levels))] 
-            frames.append(interpolated_frame)
-            
+        levels = current_levels[np.newaxis]
+    else:
+        levels = animation_utils.interpolate_levels(last_levels, current_levels, num_frames)
         last_levels = current_levels
-            
-        for frame in frames:
-            pixels = []
-            for level in frame:
-                pixels.append(animation_utils.level_to_pixels(round(level)))
-                
-            frames_queue.appendleft(pixels)
+    
+    # One (cols, rows) mask per animation frame, spread over the next FFT period from the capture time
+    display_times = timestamp + args.animation_delay + np.arange(len(levels)) / ANIMATION_FRAMERATE
+    frames_queue.push(animation_utils.levels_to_pixels(levels), display_times)
         
+def write_led_outputs(pixels):
+    for sink in list(led_outputs):
+        try:
+            sink.write(pixels)
+        except OSError as e:
+            # Ex: the reader of a pipe went away, the other outputs keep running
+            print(f"{sink} failed, disabling it: {e}")
+            led_outputs.remove(sink)
+
+def headless_animation():
+    '''Animation without a window, the frames only go to the LED outputs'''
+    frames = FrameScheduler()
+    interval = 1 / ANIMATION_FRAMERATE
+    next_tick = time.monotonic()
+    while True:
+        main(frames)
+        pixels = frames.next_frame()
+        if pixels is not None:
+            write_led_outputs(pixels)
+
+        next_tick += interval
+        delay = next_tick - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            next_tick = time.monotonic()
+
 def mqtt_publish(args):
     broker_host = args.mqtt_host
     broker_port = args.mqtt_port
@@ -143,6 +219,11 @@ def mqtt_publish(args):
     if not broker_host or not broker_port or not mqtt_topic:
         return
     
+    try:
+        import paho.mqtt.publish as publish
+    except ImportError:
+        return
+    
     try:
         hostname = socket.gethostname()
         (hostname, _, ipaddrlist) = socket.gethostbyname_ex(hostname)
@@ -155,7 +236,9 @@ def mqtt_publish(args):
                 "address": {
                     "host": server_ip,
                     "port": args.port
-                }
+                },
+                # One port per audio stream, the first one is the address port
+                "streams": [args.port + i for i in range(len(supervisor.fft_queues))]
             }
         })
         publish.single(mqtt_topic, payload, hostname=broker_host, port=broker_port)
@@ -167,20 +250,45 @@ def mqtt_publish(args):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='''
 Analyze audio and stream FFT results over TCP while displaying an animation on the screen.
-Provide either --input-id or --file to specify the audio source. If both are provided --file will be used.
+Provide either --input-id, --file, --raw or --synth to specify the audio source. If several are provided the first one in this order is used: --file, --input-id, --raw, --synth.
+Repeat the source option to analyze several streams at once, each in its own process. Stream N is served on --port + N.
 ''')
     parser.add_argument('--sample-rate', default=os.getenv('DEFAULT_FFT_SAMPLERATE', 20), type=int, help='FFT sampling rate. Defaults to 20 samples/s (FFT analysis every 50ms)')
     parser.add_argument('--host', default=os.getenv('TCP_SERVER_HOST', '0.0.0.0'), type=str, help='The host to bind the TCP server. Defaults to "0.0.0.0"')
     parser.add_argument('--port', default=os.getenv('TCP_SERVER_PORT', 12345), type=int, help='The port to bind the TCP server. Defaults to 12345')
-    parser.add_argument('--file', type=str, help='Path to the audio wav file')
-    parser.add_argument('--input-id', type=str, help='The id of the input device to capture. Use --list-inputs to list all available input devices')
+    parser.add_argument('--client-lag-budget', default=os.getenv('TCP_CLIENT_LAG_BUDGET', 1000), type=int, help='Disconnect TCP clients that stop reading for longer than this many ms. Defaults to 1000')
+    parser.add_argument('--udp-target', default=os.getenv('UDP_TARGET'), type=str, help='Also send every FFT frame once over UDP to this multicast group or broadcast address, ex: 239.1.2.3:5005. Stream N is sent to port + N. Disabled by default')
+    parser.add_argument('--db-range', default=os.getenv('TCP_DB_RANGE', '-60:0'), type=str, help='dB range "min:max" mapped to 0-255 for the clients asking for quantized levels. Defaults to -60:0')
+    parser.add_argument('--shm-name', default=os.getenv('SHM_NAME'), type=str, help='Also write the FFT frames to a shared memory ring buffer with this name for local consumers (see src/shm_ring.py). Stream N uses name-N. Disabled by default')
+    parser.add_argument('--shm-capacity', default=os.getenv('SHM_CAPACITY', 256), type=int, help='Number of frames kept in the shared memory ring buffer. Defaults to 256')
+    parser.add_argument('--file', type=str, action='append', help='Path to the audio wav file. Can be repeated')
+    parser.add_argument('--input-id', type=str, action='append', help='The id of the input device to capture. Use --list-inputs to list all available input devices. Can be repeated')
+    parser.add_argument('--offline', type=str, metavar='OUTPUT', help='Analyze the --file as fast as possible without playback, write the band levels and their timestamps to OUTPUT (.npz or memory-mapped .npy) and exit. File N is written to OUTPUT-N')
+    parser.add_argument('--raw', type=str, action='append', help='Read headerless PCM from a file, a named pipe or "-" for stdin, ex: the output of ffmpeg -f s16le. Can be repeated')
+    parser.add_argument('--raw-rate', type=int, default=44100, help='Framerate of the --raw audio. Defaults to 44100')
+    parser.add_argument('--raw-channels', type=int, default=2, help='Channels of the --raw audio. Defaults to 2')
+    parser.add_argument('--raw-format', type=str, default='s16le', choices=list(audio_source.RAW_FORMATS), help='Sample format of the --raw audio. Defaults to s16le')
+    parser.add_argument('--synth', type=str, action='append', help='Analyze a generated signal, a comma separated mix of sine:FREQ, sweep:LOW-HIGH:SECONDS and noise. Ex: sine:440,noise. Can be repeated')
+    parser.add_argument('--synth-rate', type=int, default=44100, help='Framerate of the --synth signal. Defaults to 44100')
+    parser.add_argument('--speed', type=float, default=1.0, help='Pace --raw, --synth and --file with --no-playback at this many times real time, 0 runs as fast as possible. Defaults to 1')
+    parser.add_argument('--no-playback', action='store_true', help="Don't play the --file on the output device")
+    parser.add_argument('--device-buffer', type=int, default=os.getenv('AUDIO_DEVICE_BUFFER', 0), help='Frames per buffer requested from the --input-id device. Smaller buffers lower the input latency, the analysis still runs every 1 / --sample-rate seconds. Defaults to the analysis hop')
+    parser.add_argument('--low-latency', action='store_true', help=f'Publish every band vector as soon as it is analyzed and default --device-buffer to {audio_source.LOW_LATENCY_DEVICE_BUFFER} frames')
     parser.add_argument('--list-inputs', action='store_true', help='List all available input devices')
     parser.add_argument('--fps', type=int, default=os.getenv('DEFAULT_ANIMATION_FRAMERATE', 60), help="Animation framerate in frames per second. Defaults to 60")
     parser.add_argument('--mqtt-host', type=str, default=os.getenv('MQTT_BROKER_HOST', '127.0.0.1'), help="MQTT Broker host to anounce the server address. Defaults to 127.0.0.1")
     parser.add_argument('--mqtt-port', type=int, default=os.getenv('MQTT_BROKER_PORT', 1883), help="MQTT Broker port to anounce the server address. Defaults to 1883")
     parser.add_argument('--mqtt-topic', type=str, default=os.getenv('MQTT_ANNOUNCEMENT_TOPIC', 'acme/devices/lighting'), help="MQTT topic to publish anouncement")
     parser.add_argument('--emma-alpha', type=float, default=os.getenv('FFT_EMMA_DEFAULT', 0.5), help="The alpha value for the exponential moving average. Defaults to 0.5")
+    parser.add_argument('--bands', type=str, default=os.getenv('FFT_BANDS', 'octave'), help="Frequency band layout: octave (the default 10 bands), third-octave[:LOW-HIGH], log:N[:LOW-HIGH], mel:N[:LOW-HIGH], erb:N[:LOW-HIGH], custom:EDGE,EDGE,... (hz) or a .json file. Generated layouts cover 20-16000hz by default. Ex: mel:32")
+    parser.add_argument('--peak-window', type=float, default=os.getenv('FFT_PEAK_WINDOW', 12.5), help="Length in seconds of the band peak history used to normalize the amplitudes. Defaults to 12.5")
+    parser.add_argument('--stft-window', type=int, default=os.getenv('FFT_STFT_WINDOW', 0), help="Analyze overlapping windows of this many samples. The hop between two windows is given by --sample-rate. Disabled by default (back to back slices)")
+    parser.add_argument('--decimate', action='store_true', help="Decimate high rate audio (ex: 96khz) down to the lowest rate that still covers the highest frequency band before the analysis")
+    parser.add_argument('--multirate', type=int, default=os.getenv('FFT_MULTIRATE', 0), help="Analyze the low bands on audio decimated this many more times (power of two up to 32) with the same FFT size, for a finer bass resolution. Disabled by default")
     parser.add_argument('--disable-server', action='store_true', help="Disable streaming FFT results over TCP. By default, the server is enabled")
+    parser.add_argument('--animation-delay', type=float, default=os.getenv('ANIMATION_DELAY', 0), help="Seconds between the capture of the audio and the display of its animation frames, ex: to match the latency of the speakers. Frames that are late are dropped. Defaults to 0")
+    parser.add_argument('--led-output', type=str, action='append', help="Also send the animation frames to a LED matrix: rgb:PATH writes packed RGB frames to a file, a named pipe or a device node, artnet:HOST[:PORT][/UNIVERSE] sends them as Art-Net DMX (170 LEDs per universe). Works with --disable-animation. Can be repeated")
+    parser.add_argument('--led-serpentine', action='store_true', help="The LED outputs are wired as serpentine strips, every other column runs from the top")
     parser.add_argument('--disable-animation', action='store_true', help="Disable the built-in animation, run only the TCP server")
     parser.add_argument('--disable-emma', action='store_true', help="Disable the exponential moving average for the FFT results")
     parser.add_argument('--disable-mqtt-anouncement', action='store_true', help="Disable anouncing server address over MQTT")
@@ -195,47 +303,155 @@ Provide either --input-id or --file to specify the audio source. If both are pro
         audio_source.list_audio_input_devices()
         exit(0)
 
-    if not (args.input_id or args.file):
-        parser.error("Provide either --input-id or --file")
+    if not (args.input_id or args.file or args.raw or args.synth):
+        parser.error("Provide either --input-id, --file, --raw or --synth")
+
+    if args.offline and not args.file:
+        parser.error("--offline only works with --file")
+        
+    if args.offline and os.path.splitext(args.offline)[1] not in ('.npz', '.npy'):
+        parser.error("The --offline output must be a .npz or .npy file")
     
     
     if args.sample_rate < 1:
         parser.error("Sample rate must be greater than 0")
         
-    if args.fps < args.sample_rate:
+    try:
+        args.db_range = encoding.parse_db_range(args.db_range)
+    except ValueError:
+        parser.error(f"Invalid dB range {args.db_range}, expected min:max")
+        
+    if args.client_lag_budget < 1:
+        parser.error("Client lag budget must be greater than 0")
+        
+    if args.device_buffer < 0:
+        parser.error("Device buffer must be greater than or equal to 0")
+        
+    if args.low_latency and not args.device_buffer:
+        args.device_buffer = audio_source.LOW_LATENCY_DEVICE_BUFFER
+        
+    if args.speed < 0:
+        parser.error("Speed must be greater than or equal to 0")
+        
+    if args.raw_rate < 1 or args.raw_channels < 1 or args.synth_rate < 1:
+        parser.error("Framerates and channels must be greater than 0")
+        
+    if args.synth:
+        try:
+            for spec in args.synth:
+                audio_source.SyntheticSource.parse(spec)
+        except ValueError as e:
+            parser.error(str(e))
+        
+    if args.shm_capacity < 1:
+        parser.error("Shared memory capacity must be greater than 0")
+        
+    if args.stft_window < 0:
+        parser.error("STFT window must be greater than or equal to 0")
+        
+    if args.multirate and (args.multirate < 0 or args.multirate > resample.MAX_FACTOR or args.multirate & (args.multirate - 1)):
+        parser.error(f"Multirate factor must be a power of two up to {resample.MAX_FACTOR}")
+        
+    try:
+        frequency_bands = bands.parse_layout(args.bands)
+    except (ValueError, OSError, KeyError, IndexError) as e:
+        parser.error(f"Invalid band layout {args.bands}: {e}")
+        
+    if not 0 < args.emma_alpha <= 1:
+        parser.error("The EMA alpha must be greater than 0 and at most 1")
+        
+    if args.peak_window <= 0:
+        parser.error("Peak window must be greater than 0")
+        
+    # Offline mode has no animation
+    if not args.offline and args.fps < args.sample_rate:
         parser.error("Animation framerate must be greater than or equal to the FFT sampling rate")
 
     FFT_SAMPLING_RATE = args.sample_rate
     ANIMATION_FRAMERATE = args.fps
 
+    analysis_options = {
+        'sample_rate': FFT_SAMPLING_RATE,
+        'stft_window': args.stft_window,
+        'bands': frequency_bands,
+        'peak_window': args.peak_window,
+        'enable_emma': not args.disable_emma,
+        'emma_alpha': args.emma_alpha,
+        'decimate': args.decimate,
+        'multirate': args.multirate,
+        'playback': not args.no_playback,
+        'speed': args.speed,
+        'device_buffer': args.device_buffer,
+        'raw_rate': args.raw_rate,
+        'raw_channels': args.raw_channels,
+        'raw_format': args.raw_format,
+        'synth_rate': args.synth_rate,
+    }
+
     print(f'FFT sampling rate (rate/s): {FFT_SAMPLING_RATE}')
+    
+    if args.offline:
+        for i, source in enumerate(args.file):
+            offline.analyze_file(source, offline.output_path(args.offline, i), analysis_options)
+        exit(0)
+        
     if not args.disable_animation:
         print(f'Animation framerate (fps): {ANIMATION_FRAMERATE}')
         
-    thread = threading.Thread(target=audio_worker)
-    thread.start()
+    # Start the audio workers before any other thread so that worker processes are forked from a quiet process
+    supervisor = streams.Supervisor(audio_sources(), analysis_options)
+    supervisor.start()
+    pending_values = [deque() for _ in supervisor.fft_queues]
+
+    if args.shm_name:
+        for stream in range(len(supervisor.fft_queues)):
+            shm_rings.append(shm_ring.ShmRingWriter(shm_ring_name(stream), len(frequency_bands), FFT_SAMPLING_RATE, args.shm_capacity))
+            print("Shared memory ring:", shm_ring_name(stream))
     
     if not args.disable_server:
-        tcp_server.start(FFT_SAMPLING_RATE, len(fft.frequency_bands), args.host, args.port)
+        tcp_server.start(FFT_SAMPLING_RATE, len(frequency_bands), args.host, args.port, len(supervisor.fft_queues), args.client_lag_budget / 1000, args.udp_target, args.db_range)
         while not tcp_server.ready_event.is_set():
             time.sleep(0.1)
 
-        if not args.disable_mqtt_anouncement and mqtt_enabled:
+        if not args.disable_mqtt_anouncement:
             mqtt_publish(args)
         
-    if args.disable_animation and args.disable_server:
+    for spec in args.led_output or []:
+        try:
+            sink = led_sinks.open_sink(spec, len(frequency_bands), animation_utils.LED_ROWS, args.led_serpentine)
+        except (ValueError, OSError) as e:
+            parser.error(str(e))
+        led_outputs.append(sink)
+        print("LED output:", sink)
+
+    if args.disable_animation and args.disable_server and not args.shm_name and not led_outputs:
         parser.error("Nothing to do if both the TCP server and the animations are disabled")
         
+    if args.low_latency:
+        for stream in range(len(supervisor.fft_queues)):
+            threading.Thread(target=forward_fft_values, args=(stream,), daemon=True).start()
+        
     try:
-        if args.disable_animation:
+        if args.disable_animation and led_outputs:
+            headless_animation()
+        elif args.disable_animation and args.low_latency:
+            # Everything runs in the forwarding threads
+            while True:
+                time.sleep(1)
+        elif args.disable_animation:
             while True:
                 main()
         else:
-            screen.init(ANIMATION_FRAMERATE)
-            screen.mainloop(main)
+            from src import screen
+            screen.init(ANIMATION_FRAMERATE, len(frequency_bands))
+            screen.mainloop(main, write_led_outputs if led_outputs else None)
     except KeyboardInterrupt:
         exit(0)
     finally:
-        stop_event.set()
+        supervisor.stop()
         if not args.disable_server:
             tcp_server.stop()
+        for ring in shm_rings:
+            ring.close()
+        for sink in led_outputs:
+            sink.close()
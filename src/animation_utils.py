@@ -1,48 +1,21 @@
-from . import screen
+import numpy as np
 
-def new_frame(pixel_value = 0):
-    frame = [pixel_value] * screen.LED_ROWS
-    return frame
+LED_ROWS = 8
 
-def set_pixels(start, end, state, dst = None):
-    if dst == None:
-        dst = []
-    for i in range(start, end + 1):
-        dst[i] = state
-    
-    return dst
+# Lowest amplitude (dBFS) that lights each row, from the bottom one
+LEVEL_THRESHOLDS = np.array([-30, -18, -15, -12, -9, -6, -3, -1.5])
 
-def level_to_pixels(level):
-    frame = new_frame()
-    if level < 0:
-        return frame
+def get_levels(values):
+    '''Highest lit row of every band, -1 below the first threshold'''
+    return np.digitize(values, LEVEL_THRESHOLDS) - 1
 
-    set_pixels(0, level, 1, frame)
-    return frame
-        
-def get_level(max_amp):
-    if max_amp >= -1.5:
-        return 7
-    
-    if max_amp >= -3:
-        return 6
-    
-    if max_amp >= -6:
-        return 5
-    
-    if max_amp >= -9:
-        return 4
-    
-    if max_amp >= -12:
-        return 3
-    
-    if max_amp >= -15:
-        return 2
-    
-    if max_amp >= -18:
-        return 1
-    
-    if max_amp >= -30:
-        return 0
-    
-    return -1
\ No newline at end of file
+def interpolate_levels(start, end, frames_count):
+    '''(frames_count, bands) levels going from start to end, both included'''
+    t = (np.arange(frames_count) / (frames_count - 1))[:, np.newaxis]
+    return (1 - t) * start + t * end
+
+def levels_to_pixels(levels):
+    '''(frames, cols) levels to (frames, cols, rows) boolean pixel masks,
+    every row up to the rounded level is lit'''
+    rows = np.arange(LED_ROWS)
+    return np.rint(levels)[..., np.newaxis] >= rows
\ No newline at end of file
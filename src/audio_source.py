@@ -1,6 +1,27 @@
+import os
+import sys
 import time
-import wave
-import pyaudio
+import threading
+import numpy as np
+from . import fft
+from .wav_file import WavFile
+
+# Imported by require_pyaudio on first use: it's only needed for audio devices and
+# playback, loading PortAudio is slow and fails on machines without an audio stack
+pyaudio = None
+
+# Raw PCM sample formats and their sample width
+RAW_FORMATS = {
+    's16le': 2,
+    's8': 1,
+}
+
+SYNTH_AMPLITUDE = 16000
+
+# Audio buffered between the capture callback and the analysis
+CAPTURE_RING_SECONDS = 2
+# Device buffer used by the low latency mode when none is given
+LOW_LATENCY_DEVICE_BUFFER = 128
 
 def next_divisible_by_32(n):
     remainder = n % 32
@@ -8,107 +29,446 @@ def next_divisible_by_32(n):
         return int(n + 32)
     else:
         return int(n + (32 - remainder))
-    
-def stream_generator(p, stream, chunk_size):
-    try:
-        while True:
-            data = stream.read(chunk_size)
-            yield data
-    except GeneratorExit:
-        stream.stop_stream()
-        stream.close()
-        p.terminate()
-    
-    
-def wav_generator(p, wf, output_stream, chunk_size):
-    try:
-        data = wf.readframes(chunk_size)
-
-        while data:
-            output_stream.write(data)
-            yield data
-            data = wf.readframes(chunk_size)
-
-        output_stream.stop_stream()
-        output_stream.close()
-        p.terminate()
-
-    except GeneratorExit:
-        output_stream.stop_stream()
-        output_stream.close()
-        p.terminate()
-
-def open_wav(source, chunk_size_factor):
-    wf = wave.open(source, 'rb')
-    framerate = wf.getframerate()
-    sample_width = wf.getsampwidth()
-    channels = wf.getnchannels()
-    
-    p = pyaudio.PyAudio()
-    
-    output_stream = p.open(format=p.get_format_from_width(sample_width),
-                    channels=channels,
-                    rate=framerate,
-                    output=True)
 
+def samples_per_chunk(framerate, chunk_size_factor):
+    '''Number of samples analyzed at once to get chunk_size_factor analyses per second'''
     samples_count = (1 / chunk_size_factor) / (1 / framerate)
-    samples_count = next_divisible_by_32(samples_count)
-    chunk_size = 4 * samples_count
+    return next_divisible_by_32(samples_count)
 
-    return (samples_count, framerate, sample_width, channels, wav_generator(p, wf, output_stream, chunk_size))
+def require_pyaudio():
+    global pyaudio
+    if pyaudio is None:
+        try:
+            import pyaudio as module
+        except (ImportError, OSError) as e:
+            raise RuntimeError(f"PyAudio is not available, it's needed for audio devices and playback: {e}")
+        pyaudio = module
+    return pyaudio
 
-def open_stream(source, chunk_size_factor):
-    p = pyaudio.PyAudio()
-    
-    info = p.get_default_host_api_info()
-    input_devices = []
-    for i in range(info.get('deviceCount')):
-        device = p.get_device_info_by_host_api_device_index(0, i)
-        if device.get('maxInputChannels') > 0:
-            input_devices.append(device)
-            
-    if not len(input_devices):
-        raise RuntimeError('No input devices found')
-        
-    audio_input = None
-    for d in input_devices:
-        if int(d.get('index')) == int(source):
-            audio_input = d
-            break
+def paced(blocks, framerate, speed):
+    '''Hand out the blocks no faster than `speed` times real time, 0 disables pacing'''
+    if not speed:
+        yield from blocks
+        return
 
-    if audio_input is None:
-        raise RuntimeError(f"Input device {source} not found")
-    
-    framerate = int(audio_input.get('defaultSampleRate'))
-    sample_width = 2 # Mic streams default to 16bit
-    channels = audio_input.get('maxInputChannels')
+    started = time.monotonic()
+    played = 0
+    for block in blocks:
+        played += len(block)
+        delay = started + played / (framerate * speed) - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        yield block
+
+class SampleRing:
+    '''Single producer/single consumer ring of (frames, channels) samples.
+
+    The indices only grow, the producer only moves write_index and the consumer
+    only read_index so no lock is needed. Frames that don't fit because the
+    consumer fell behind are dropped and counted in overflows.
+
+    last_write is (write index, capture time of the newest frame), swapped as
+    one tuple so the consumer never sees the index of one write with the time
+    of another'''
+
+    def __init__(self, capacity, channels, dtype):
+        self.capacity = capacity
+        self.write_index = 0
+        self.read_index = 0
+        self.overflows = 0
+        self.last_write = (0, None)
+        self._buffer = np.zeros((capacity, channels), dtype=dtype)
+        self._data_ready = threading.Event()
+
+    def available(self):
+        return self.write_index - self.read_index
+
+    def _copy(self, index, count):
+        '''The buffer slices holding count frames starting at index'''
+        start = index % self.capacity
+        head = min(count, self.capacity - start)
+        return self._buffer[start:start + head], self._buffer[:count - head]
+
+    def write(self, frames, timestamp = None):
+        free = self.capacity - self.available()
+        if len(frames) > free:
+            self.overflows += len(frames) - free
+            frames = frames[:free]
+
+        count = len(frames)
+        first, second = self._copy(self.write_index, count)
+        first[:] = frames[:len(first)]
+        second[:] = frames[len(first):]
+        self.write_index += count
+        self.last_write = (self.write_index, timestamp)
+        self._data_ready.set()
+
+    def read(self, out, timeout = None):
+        '''Fill out with the next len(out) frames. Returns False on timeout'''
+        count = len(out)
+        while self.available() < count:
+            self._data_ready.clear()
+            # The producer may have written between the check and the clear
+            if self.available() >= count:
+                break
+            if not self._data_ready.wait(timeout):
+                return False
+
+        first, second = self._copy(self.read_index, count)
+        out[:len(first)] = first
+        out[len(first):] = second
+        self.read_index += count
+        return True
+
+class AudioSource:
+    '''Common interface of the audio backends.
+
+    framerate, channels and sample_width (bytes) describe the sample format, dtype is
+    the matching numpy dtype. samples_count is the number of samples between two
+    analyses and block_size the number of frames the backend prefers to hand out at once.
+
+    blocks() yields (frames, channels) arrays, they may be views into a buffer
+    reused by the next block. overflows counts the frames lost because the
+    analysis didn't keep up. capture_time() is the wall clock time at which
+    the last frame of the last block was captured'''
+
+    framerate = None
+    channels = None
+    sample_width = None
+    samples_count = None
+    block_size = None
+    overflows = 0
+
+    @property
+    def dtype(self):
+        return fft.sample_dtype(self.sample_width)
+
+    def blocks(self):
+        raise NotImplementedError
+
+    def capture_time(self):
+        return time.time()
+
+    def close(self):
+        pass
+
+class WavSource(AudioSource):
+    '''A memory-mapped WAV file, played on the default output device while it's analyzed.
+    Without playback the file is paced at `speed` times real time instead'''
+
+    def __init__(self, path, chunk_size_factor, playback = True, speed = 1.0):
+        self.wav = WavFile(path)
+        self.framerate = self.wav.framerate
+        self.channels = self.wav.channels
+        self.sample_width = self.wav.sample_width
+        self.samples_count = samples_per_chunk(self.framerate, chunk_size_factor)
+        # Paced in real time the blocks are released when their audio would have been heard,
+        # one hop at a time so each band vector comes out on time
+        self.block_size = self.samples_count if not playback and speed else 4 * self.samples_count
+        self.speed = speed
+        self._p = None
+        self._output_stream = None
+        self._block_duration = 0
+
+        if playback:
+            require_pyaudio()
+            self._p = pyaudio.PyAudio()
+            self._output_stream = self._p.open(format=self._p.get_format_from_width(self.sample_width),
+                                               channels=self.channels,
+                                               rate=self.framerate,
+                                               output=True)
+
+    def blocks(self):
+        if self._output_stream is None:
+            yield from paced(self.wav.blocks(self.block_size), self.framerate, self.speed)
+            return
+
+        for data in self.wav.blocks(self.block_size):
+            # Blocks until the device took the chunk, this paces the analysis
+            self._output_stream.write(memoryview(data).cast('B'))
+            self._block_duration = len(data) / self.framerate
+            yield data
+
+    def capture_time(self):
+        '''With playback the block was just handed to the device and is heard from now on,
+        its last sample one block later'''
+        return time.time() + self._block_duration
+
+    def close(self):
+        if self._output_stream is not None:
+            self._output_stream.stop_stream()
+            self._output_stream.close()
+            self._p.terminate()
+            self._output_stream = None
+        self.wav.close()
+
+class DeviceSource(AudioSource):
+    '''A PyAudio input device, captured as 16 bit samples.
+
+    PortAudio calls back with frames_per_buffer frames at a time and the callback
+    only copies them into a SampleRing, blocks() pulls one analysis hop at a time
+    from it. The device buffer can be much smaller than the hop for a lower input
+    latency, and a slow analysis drops frames in the ring (counted) instead of
+    stalling the capture'''
+
+    def __init__(self, device_id, chunk_size_factor, frames_per_buffer = None):
+        require_pyaudio()
+        self._p = pyaudio.PyAudio()
+
+        info = self._p.get_default_host_api_info()
+        input_devices = []
+        for i in range(info.get('deviceCount')):
+            device = self._p.get_device_info_by_host_api_device_index(0, i)
+            if device.get('maxInputChannels') > 0:
+                input_devices.append(device)
+
+        if not len(input_devices):
+            self._p.terminate()
+            raise RuntimeError('No input devices found')
+
+        audio_input = None
+        for d in input_devices:
+            if int(d.get('index')) == int(device_id):
+                audio_input = d
+                break
+
+        if audio_input is None:
+            self._p.terminate()
+            raise RuntimeError(f"Input device {device_id} not found")
+
+        self.framerate = int(audio_input.get('defaultSampleRate'))
+        self.sample_width = 2 # Mic streams default to 16bit
+        self.channels = audio_input.get('maxInputChannels')
+        self.samples_count = samples_per_chunk(self.framerate, chunk_size_factor)
+        self.block_size = self.samples_count
+        self.frames_per_buffer = frames_per_buffer or self.block_size
+        # Times PortAudio itself reported an input overflow
+        self.device_overflows = 0
+
+        capacity = max(CAPTURE_RING_SECONDS * self.framerate, 4 * max(self.block_size, self.frames_per_buffer))
+        self._ring = SampleRing(capacity, self.channels, self.dtype)
+        self._block = np.empty((self.block_size, self.channels), dtype=self.dtype)
+
+        self._stream = self._p.open(
+            format = pyaudio.paInt16,
+            channels = self.channels,
+            rate = self.framerate,
+            input = True,
+            input_device_index = audio_input.get('index'),
+            frames_per_buffer = self.frames_per_buffer,
+            stream_callback = self._capture
+        )
+
+    @property
+    def overflows(self):
+        return self._ring.overflows
+
+    def _capture(self, in_data, frame_count, time_info, status):
+        '''Runs on the PortAudio thread, keep it short'''
+        now = time.time()
+        if status & pyaudio.paInputOverflow:
+            self.device_overflows += 1
+
+        # The ADC time of the first frame is on the stream clock, not every host API reports it
+        adc_time = time_info.get('input_buffer_adc_time') if time_info else None
+        if adc_time:
+            captured = now - (time_info['current_time'] - adc_time) + (frame_count - 1) / self.framerate
+        else:
+            captured = now
+
+        self._ring.write(fft.sample_frames(in_data, self.sample_width, self.channels), min(captured, now))
+        return (None, pyaudio.paContinue)
+
+    def capture_time(self):
+        write_index, captured = self._ring.last_write
+        if captured is None:
+            return time.time()
+        return captured - (write_index - self._ring.read_index) / self.framerate
+
+    def blocks(self):
+        while self._stream is not None:
+            if self._ring.read(self._block, timeout=1):
+                yield self._block
+            elif not self._stream.is_active():
+                return
+
+    def close(self):
+        if self._stream is not None:
+            self._stream.stop_stream()
+            self._stream.close()
+            self._p.terminate()
+            self._stream = None
+
+class RawSource(AudioSource):
+    '''Headerless interleaved PCM, ex: the output of `ffmpeg -f s16le -` or `arecord -t raw`.
+
+    "-" reads stdin, a regular file is memory-mapped and anything else (a named pipe)
+    is read into a reused buffer. Producers that don't pace themselves are paced at
+    `speed` times real time'''
+
+    def __init__(self, path, chunk_size_factor, framerate, channels, sample_format = 's16le', speed = 1.0):
+        if sample_format not in RAW_FORMATS:
+            raise ValueError(f"Unsupported raw format {sample_format}, use one of {', '.join(RAW_FORMATS)}")
+
+        self.path = path
+        self.framerate = framerate
+        self.channels = channels
+        self.sample_width = RAW_FORMATS[sample_format]
+        self.samples_count = samples_per_chunk(self.framerate, chunk_size_factor)
+        self.block_size = self.samples_count
+        self.speed = speed
+        self._file = None
+        self._samples = None
+
+        if path == '-':
+            self._file = sys.stdin.buffer
+        elif os.path.isfile(path):
+            frames_count = os.path.getsize(path) // (self.sample_width * channels)
+            if frames_count:
+                self._samples = np.memmap(path, dtype=self.dtype, mode='r', shape=(frames_count, channels))
+            else:
+                self._samples = np.empty((0, channels), dtype=self.dtype)
+        else:
+            self._file = open(path, 'rb', buffering=0)
+
+    def _read(self):
+        frame_size = self.sample_width * self.channels
+        buffer = bytearray(self.block_size * frame_size)
+        view = memoryview(buffer)
+        frames = np.frombuffer(buffer, dtype=self.dtype).reshape(-1, self.channels)
+
+        while True:
+            filled = 0
+            while filled < len(buffer):
+                count = self._file.readinto(view[filled:])
+                if not count:
+                    break
+                filled += count
+
+            # A trailing partial frame is dropped
+            frames_count = filled // frame_size
+            if frames_count:
+                yield frames[:frames_count]
+            if filled < len(buffer):
+                return
+
+    def blocks(self):
+        if self._samples is not None:
+            blocks = (self._samples[i:i + self.block_size] for i in range(0, len(self._samples), self.block_size))
+        else:
+            blocks = self._read()
+
+        yield from paced(blocks, self.framerate, self.speed)
+
+    def close(self):
+        if self._file is not None and self._file is not sys.stdin.buffer:
+            self._file.close()
+        self._file = None
+        self._samples = None
+
+class SyntheticSource(AudioSource):
+    '''Generated 16 bit mono test signals, for load testing without a sound card.
+
+    The spec is a comma separated list of signals mixed together: sine:FREQ,
+    sweep:LOW-HIGH:SECONDS (logarithmic, restarts every SECONDS) and noise.
+    The signal never ends, it's paced at `speed` times real time (0 is as fast as possible)'''
+
+    def __init__(self, spec, chunk_size_factor, framerate = 44100, speed = 1.0):
+        self.signals = self.parse(spec)
+        self.framerate = framerate
+        self.channels = 1
+        self.sample_width = 2
+        self.samples_count = samples_per_chunk(self.framerate, chunk_size_factor)
+        self.block_size = self.samples_count
+        self.speed = speed
+        self._rng = np.random.default_rng()
+
+    @staticmethod
+    def parse(spec):
+        signals = []
+        for part in spec.split(','):
+            kind, _, params = part.strip().partition(':')
+            try:
+                if kind == 'sine':
+                    signals.append(('sine', float(params)))
+                elif kind == 'sweep':
+                    frequencies, _, seconds = params.partition(':')
+                    low, _, high = frequencies.partition('-')
+                    low, high, seconds = float(low), float(high), float(seconds or 10)
+                    # The sweep is exponential, it needs two different positive frequencies
+                    if not (0 < low < np.inf and 0 < high < np.inf and low != high and 0 < seconds < np.inf):
+                        raise ValueError(part)
+                    signals.append(('sweep', low, high, seconds))
+                elif kind == 'noise':
+                    signals.append(('noise',))
+                else:
+                    raise ValueError(kind)
+            except ValueError:
+                raise ValueError(f"Invalid synthetic signal {part}, expected sine:FREQ, sweep:LOW-HIGH:SECONDS or noise")
+        return signals
+
+    def _generate(self):
+        block_size = self.block_size
+        offsets = np.arange(block_size) / self.framerate
+        signal = np.empty(block_size)
+        mixed = np.empty(block_size)
+        samples = np.empty((block_size, 1), dtype=self.dtype)
+        # Cycles into the sine or seconds into the sweep, carried over so the signal is continuous
+        phases = [0.0] * len(self.signals)
+        amplitude = SYNTH_AMPLITUDE / len(self.signals)
+
+        while True:
+            mixed.fill(0)
+            for i, params in enumerate(self.signals):
+                if params[0] == 'sine':
+                    np.multiply(offsets, params[1], out=signal)
+                    signal += phases[i]
+                    phases[i] = (phases[i] + params[1] * block_size / self.framerate) % 1
+                elif params[0] == 'sweep':
+                    # The frequency grows as low * e^(rate * t), the phase in cycles is its integral
+                    _, low, high, seconds = params
+                    rate = np.log(high / low) / seconds
+                    np.add(offsets, phases[i], out=signal)
+                    np.mod(signal, seconds, out=signal)
+                    signal *= rate
+                    np.expm1(signal, out=signal)
+                    signal *= low / rate
+                    phases[i] = (phases[i] + block_size / self.framerate) % seconds
+                else:
+                    self._rng.standard_normal(out=signal)
+                    mixed += signal * (0.3 * amplitude)
+                    continue
+
+                np.sin(2 * np.pi * signal, out=signal)
+                mixed += signal * amplitude
+
+            np.clip(mixed, -32768, 32767, out=samples[:, 0], casting='unsafe')
+            yield samples
+
+    def blocks(self):
+        yield from paced(self._generate(), self.framerate, self.speed)
+
+def open_audio(source, source_type, options):
+    '''The AudioSource of a --file (wav), --input-id (stream), --raw or --synth source'''
+    chunk_size_factor = options['sample_rate']
+    speed = options.get('speed', 1.0)
 
-    samples_count = (1 / chunk_size_factor) / (1 / framerate)
-    samples_count = next_divisible_by_32(samples_count)
-    chunk_size = samples_count
-    
-    stream = p.open(
-        format = pyaudio.paInt16,
-        channels = channels,
-        rate = framerate,
-        input = True,
-        input_device_index = audio_input.get('index'),
-        frames_per_buffer = chunk_size
-    )
-    
-    return (samples_count, framerate, sample_width, channels, stream_generator(p, stream, chunk_size))
-    
-
-def open_audio(source, source_type, chunk_size_factor):
     if source_type == 'wav':
-        return open_wav(source, chunk_size_factor)
-    
+        return WavSource(source, chunk_size_factor, playback=options.get('playback', True), speed=speed)
+
     if source_type == 'stream':
-        return open_stream(source, chunk_size_factor)
-    
+        return DeviceSource(source, chunk_size_factor, options.get('device_buffer'))
+
+    if source_type == 'raw':
+        return RawSource(source, chunk_size_factor, options['raw_rate'], options['raw_channels'], options['raw_format'], speed=speed)
+
+    if source_type == 'synth':
+        return SyntheticSource(source, chunk_size_factor, options['synth_rate'], speed=speed)
+
     raise ValueError(f"Invalid source type {source_type}")
-    
+
 def list_audio_input_devices():
+    require_pyaudio()
     p = pyaudio.PyAudio()
     info = p.get_default_host_api_info()
     input_devices = []
@@ -118,10 +478,10 @@ def list_audio_input_devices():
             input_devices.append(device)
 
     p.terminate()
-            
+
     if not len(input_devices):
         print('No input devices found')
         return
-        
+
     for d in input_devices:
-        print(d.get('index'), d.get('name'))
\ No newline at end of file
+        print(d.get('index'), d.get('name'))
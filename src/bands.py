@@ -0,0 +1,100 @@
+'''Frequency band layouts. A layout is a list of (low hz, high hz, alpha offset) tuples like fft.frequency_bands'''
+
+import json
+import numpy as np
+from . import fft
+
+DEFAULT_RANGE = (20, 16000)
+
+LAYOUTS = ('octave', 'third-octave', 'log', 'mel', 'erb', 'custom')
+
+def alpha_offset(low, high):
+    '''EMA alpha offset of a band, the same steps as the default octave bands:
+    the bass and the highs are smoothed more than the mids'''
+    center = np.sqrt(max(low, 1) * high)
+    if center < 62 or center >= 1000:
+        return 0.10
+    return 0.15
+
+def from_edges(edges):
+    '''Contiguous bands between consecutive edges'''
+    edges = [float(edge) for edge in edges]
+    if len(edges) < 2 or any(high <= low for low, high in zip(edges, edges[1:])):
+        raise ValueError("Band edges must be at least 2 increasing frequencies")
+    return [(low, high, alpha_offset(low, high)) for low, high in zip(edges, edges[1:])]
+
+def scale_edges(count, low, high, to_scale, from_scale):
+    '''count bands evenly spaced on a perceptual scale'''
+    return from_scale(np.linspace(to_scale(low), to_scale(high), count + 1))
+
+def log_edges(count, low, high):
+    return np.geomspace(low, high, count + 1)
+
+def mel_edges(count, low, high):
+    return scale_edges(count, low, high,
+                       lambda f: 2595 * np.log10(1 + f / 700),
+                       lambda m: 700 * (10 ** (m / 2595) - 1))
+
+def erb_edges(count, low, high):
+    '''Equivalent rectangular bandwidth rate scale (Glasberg & Moore)'''
+    return scale_edges(count, low, high,
+                       lambda f: 21.4 * np.log10(1 + 0.00437 * f),
+                       lambda e: (10 ** (e / 21.4) - 1) / 0.00437)
+
+def third_octave_edges(low, high):
+    '''Base 2 third octave bands centered on 1khz whose centers fall within low-high'''
+    first = int(np.ceil(3 * np.log2(low / 1000)))
+    last = int(np.floor(3 * np.log2(high / 1000)))
+    centers = 1000 * 2 ** (np.arange(first, last + 1) / 3)
+    return np.append(centers * 2 ** (-1 / 6), centers[-1] * 2 ** (1 / 6))
+
+def parse_range(value):
+    low, _, high = value.partition('-')
+    frequency_range = (float(low), float(high))
+    if not 0 < frequency_range[0] < frequency_range[1]:
+        raise ValueError(f"Invalid frequency range {value}")
+    return frequency_range
+
+def load(path):
+    '''A JSON file with either a list of [low, high] / [low, high, alpha offset] bands or {"edges": [...]}'''
+    with open(path) as f:
+        config = json.load(f)
+
+    if isinstance(config, dict):
+        return from_edges(config['edges'])
+
+    layout = []
+    for band in config:
+        low, high = float(band[0]), float(band[1])
+        if high <= low:
+            raise ValueError(f"Invalid band {band} in {path}")
+        layout.append((low, high, float(band[2]) if len(band) > 2 else alpha_offset(low, high)))
+    return layout
+
+def parse_layout(spec):
+    '''octave (default), third-octave[:LOW-HIGH], log:N[:LOW-HIGH], mel:N[:LOW-HIGH],
+    erb:N[:LOW-HIGH], custom:EDGE,EDGE,... or the path of a JSON file'''
+    if spec.endswith('.json'):
+        return load(spec)
+
+    kind, _, params = spec.partition(':')
+    if kind not in LAYOUTS:
+        raise ValueError(f"Unknown band layout {spec}, use one of {', '.join(LAYOUTS)} or a .json file")
+
+    if kind == 'octave':
+        return list(fft.frequency_bands)
+
+    if kind == 'custom':
+        return from_edges(params.split(','))
+
+    if kind == 'third-octave':
+        return from_edges(third_octave_edges(*(parse_range(params) if params else DEFAULT_RANGE)))
+
+    count, _, frequency_range = params.partition(':')
+    count = int(count) if count else 0
+    if count < 1:
+        raise ValueError(f"{kind} layouts need a band count, ex: {kind}:32")
+
+    low, high = parse_range(frequency_range) if frequency_range else DEFAULT_RANGE
+    edges = {'log': log_edges, 'mel': mel_edges, 'erb': erb_edges}[kind](count, low, high)
+    return from_edges(edges)
@@ -0,0 +1,54 @@
+import numpy as np
+
+FLOAT32 = 0 # big endian float32 dBFS, the v1 format
+INT16 = 1 # big endian int16 centi-dB
+UINT8 = 2 # uint8 levels, dB quantized over a configurable range
+DELTA = 3 # uint8 levels, only the bands that changed since the previous frame
+
+ENCODINGS = {
+    'float32': FLOAT32,
+    'int16': INT16,
+    'uint8': UINT8,
+    'delta': DELTA,
+}
+
+# Encodings sending quantized levels, their config is followed by the range
+QUANTIZED_ENCODINGS = (UINT8, DELTA)
+
+DEFAULT_DB_RANGE = (-60, 0)
+
+KEYFRAME = 0
+DELTA_FRAME = 1
+
+_INT16_MIN = np.iinfo(np.int16).min
+_INT16_MAX = np.iinfo(np.int16).max
+
+def parse_db_range(value):
+    '''"min:max" in dB to a (min, max) tuple'''
+    low, _, high = value.partition(':')
+    db_range = (float(low), float(high))
+    if db_range[0] >= db_range[1]:
+        raise ValueError(f"Invalid dB range {value}")
+    return db_range
+
+def encode_float32(values):
+    return np.asarray(values, dtype='>f4').tobytes()
+
+def encode_int16(values):
+    '''-inf (empty bands) maps to the int16 minimum'''
+    centi_db = np.nan_to_num(np.asarray(values, dtype=np.float64) * 100, neginf=_INT16_MIN, posinf=_INT16_MAX)
+    return np.clip(np.round(centi_db), _INT16_MIN, _INT16_MAX).astype('>i2').tobytes()
+
+def quantize(values, db_range):
+    '''Map dB values to 0-255 over db_range, anything below the range (including -inf) is 0'''
+    low, high = db_range
+    levels = (np.asarray(values, dtype=np.float64) - low) * (255 / (high - low))
+    return np.clip(np.round(np.nan_to_num(levels, neginf=0)), 0, 255).astype(np.uint8)
+
+def encode_keyframe(levels):
+    return bytes((KEYFRAME,)) + levels.tobytes()
+
+def encode_delta(levels, previous_levels):
+    '''A bitmask (MSB first) of the bands that changed followed by their new levels'''
+    changed = levels != previous_levels
+    return bytes((DELTA_FRAME,)) + np.packbits(changed).tobytes() + levels[changed].tobytes()
@@ -1,90 +1,262 @@
 import numpy as np
 
 _DEFAULT_ALPHA = 0.5
+_MIN_ALPHA = 0.01
 _DEFAULT_MAX_AMPLITUDE = 500
-_MAX_AMPLITUDE_BIN_SIZE = 250
+_DEFAULT_PEAK_WINDOW = 12.5 # seconds of band peaks used for normalization
 _EPSILON = 1e-10
 _STARTING_EMMA = -60
 
-_fft_queue = None
-_emma_enabled = False
+# Band levels are sent to clients as big endian float32
+WIRE_DTYPE = np.dtype('>f4')
 
+# (low hz, high hz, alpha offset added to the EMA alpha)
 frequency_bands = [
-    (1, 32, [], [_STARTING_EMMA], _DEFAULT_ALPHA + 0.10),
-    (32, 62, [], [_STARTING_EMMA], _DEFAULT_ALPHA + 0.10),
-    (63, 125, [], [_STARTING_EMMA], _DEFAULT_ALPHA + 0.15),
-    (126, 250, [], [_STARTING_EMMA], _DEFAULT_ALPHA + 0.15),
-    (251, 500, [], [_STARTING_EMMA], _DEFAULT_ALPHA + 0.15),
-    (501, 1000, [], [_STARTING_EMMA], _DEFAULT_ALPHA + 0.15),
-    (1001, 2000, [], [_STARTING_EMMA], _DEFAULT_ALPHA + 0.1),
-    (2001, 4000, [], [_STARTING_EMMA], _DEFAULT_ALPHA + 0.1),
-    (4001, 8000, [], [_STARTING_EMMA], _DEFAULT_ALPHA + 0.1),
-    (8001, 16000, [], [_STARTING_EMMA], _DEFAULT_ALPHA + 0.1)
+    (1, 32, 0.10),
+    (32, 62, 0.10),
+    (63, 125, 0.15),
+    (126, 250, 0.15),
+    (251, 500, 0.15),
+    (501, 1000, 0.15),
+    (1001, 2000, 0.1),
+    (2001, 4000, 0.1),
+    (4001, 8000, 0.1),
+    (8001, 16000, 0.1)
 ]
 
-def analyze(audio_frames, slice_size, audio_framerate, sample_width, channels):
-    global global_max
+class RollingPeak:
+    '''Sliding window maximum of the last `window` band vectors.
+
+    The history is split in blocks of `window` entries (van Herk/Gil-Werman).
+    The window ending at position p of the current block is covered by the
+    running maximum of the current block and the suffix maximum of the previous
+    block starting at p + 1. The suffix maxima are computed with one vectorized
+    scan when a block fills up, so every update is amortized O(1) regardless of
+    the window length and all bands are updated at once'''
+
+    def __init__(self, bands_count, window):
+        self.window = max(int(window), 1)
+        self._block = np.full((bands_count, self.window), -np.inf)
+        # One extra column so the suffix past the end of the block is -inf
+        self._suffix = np.full((bands_count, self.window + 1), -np.inf)
+        self._prefix = np.full(bands_count, -np.inf)
+        self._position = 0
+
+    def push(self, values):
+        '''Add one band vector and return the peak of every band over the window'''
+        position = self._position
+        self._block[:, position] = values
+        np.maximum(self._prefix, values, out=self._prefix)
+        peak = np.maximum(self._prefix, self._suffix[:, position + 1])
+
+        self._position += 1
+        if self._position == self.window:
+            self._suffix[:, :self.window] = np.maximum.accumulate(self._block[:, ::-1], axis=1)[:, ::-1]
+            self._prefix.fill(-np.inf)
+            self._position = 0
+
+        return peak
+
+class SlidingWindow:
+    '''Keeps the last `size` samples and returns a full window every `hop` new samples.
+
+    The ring buffer is stored twice back to back, so the most recent window is
+    always the contiguous slice buffer[position:position + size] and nothing
+    has to be concatenated or shifted when new samples arrive'''
+
+    def __init__(self, size, hop):
+        self.size = size
+        self.hop = hop
+        self._buffer = np.zeros(2 * size)
+        self._position = 0
+        self._pending = 0
+        self._frames = np.empty((0, size))
+
+    def _write(self, samples):
+        count = len(samples)
+        position = self._position
+        head = min(count, self.size - position)
+
+        self._buffer[position:position + head] = samples[:head]
+        self._buffer[position + self.size:position + self.size + head] = samples[:head]
+        if count > head:
+            self._buffer[:count - head] = samples[head:]
+            self._buffer[self.size:self.size + count - head] = samples[head:]
+
+        self._position = (position + count) % self.size
+
+    def push(self, samples):
+        '''Append samples, returns a (windows, size) array with one window per completed hop.
+        The returned array is reused by the next call'''
+        frames_count = (self._pending + len(samples)) // self.hop
+        if len(self._frames) < frames_count:
+            self._frames = np.empty((frames_count, self.size))
+
+        frame = 0
+        offset = 0
+        while offset < len(samples):
+            count = min(self.hop - self._pending, len(samples) - offset)
+            self._write(samples[offset:offset + count])
+            offset += count
+            self._pending += count
+
+            if self._pending == self.hop:
+                self._pending = 0
+                self._frames[frame] = self._buffer[self._position:self._position + self.size]
+                frame += 1
+
+        return self._frames[:frame]
+
+class Analyzer:
+    '''Reduces audio slices of a fixed size to per band loudness (dBFS).
+
+    Everything that only depends on the slice size and the audio framerate
+    (window, rFFT frequency grid, band boundaries) is computed once here so
+    that each slice costs one FFT and one vectorized band reduction.
+
+    With a hop smaller than the slice size (or streaming set) the analyzer runs
+    as a streaming STFT: one slice_size window is analyzed every hop samples.
+
+    All the analysis state (peak history, EMA) lives in the instance, one
+    analyzer per audio stream'''
+
+    def __init__(self, slice_size, audio_framerate, bands = None, peak_window = _DEFAULT_PEAK_WINDOW, hop = None, enable_emma = True, emma_alpha = _DEFAULT_ALPHA, streaming = False):
+        if bands is None:
+            bands = frequency_bands
+
+        if hop is None or hop >= slice_size:
+            hop = slice_size
+
+        self.slice_size = slice_size
+        self.audio_framerate = audio_framerate
+        self.hop = hop
+        self.bands_count = len(bands)
+        self.sliding_window = SlidingWindow(slice_size, hop) if hop < slice_size or streaming else None
+
+        self.window = np.hamming(slice_size)
+        self.fft_freqs = np.fft.rfftfreq(slice_size, 1.0 / audio_framerate)
+        bins_count = len(self.fft_freqs)
+
+        lows = np.array([band[0] for band in bands])
+        highs = np.array([band[1] for band in bands])
+        starts = np.searchsorted(self.fft_freqs, lows, side='left')
+        ends = np.searchsorted(self.fft_freqs, highs, side='left')
+
+        # Bands without any FFT bin (too narrow or above Nyquist) always report -inf
+        self.empty_bands = ends <= starts
+        self._valid_bands = np.flatnonzero(~self.empty_bands)
+
+        # np.maximum.reduceat reduces a[idx[i]:idx[i + 1]], so interleaving the band
+        # starts and ends gives the band maxima at the even positions. Ends past the
+        # spectrum (bands above Nyquist, in any order) are moved to the last bin, which
+        # reduceat then leaves out, those bands get it back in band_maxima.
+        valid_ends = ends[self._valid_bands]
+        reduce_indices = np.empty(2 * len(self._valid_bands), dtype=np.intp)
+        reduce_indices[0::2] = starts[self._valid_bands]
+        reduce_indices[1::2] = np.minimum(valid_ends, bins_count - 1)
+        self._reduce_indices = reduce_indices
+        self._open_ended = np.flatnonzero(valid_ends >= bins_count)
+
+        self.emma_enabled = enable_emma
+        # Above 1 the EMA would overshoot and flip around the loudness, at 0 it would never move
+        self.alphas = np.clip([emma_alpha + band[2] for band in bands], _MIN_ALPHA, 1)
+        self.ema = np.full(self.bands_count, _STARTING_EMMA, dtype=np.float64)
+        slices_per_second = audio_framerate / hop
+        self.peaks = RollingPeak(self.bands_count, np.ceil(peak_window * slices_per_second))
+        self._windowed = None
+        self._mono = None
+
+    def downmix(self, frames):
+        '''Average a (samples, channels) block into a reused float32 mono buffer.
+        The returned array is overwritten by the next call'''
+        samples_count, channels = frames.shape
+        if self._mono is None or len(self._mono) < samples_count:
+            self._mono = np.empty(samples_count, dtype=np.float32)
+
+        mono = self._mono[:samples_count]
+        if channels == 1:
+            mono[:] = frames[:, 0]
+        else:
+            np.sum(frames, axis=1, dtype=np.float32, out=mono)
+            mono *= 1 / channels
+        return mono
+
+    def frames_count(self, samples_count):
+        '''Band vectors given by a finite stream of samples_count samples. A trailing
+        partial slice is padded in block mode, it never completes a window when streaming'''
+        hops, remainder = divmod(samples_count, self.hop)
+        return hops + (1 if remainder and self.sliding_window is None else 0)
+
+    def band_maxima(self, spectra):
+        '''Maximum magnitude of each band along the last axis of the magnitude spectra'''
+        maxima = np.full(spectra.shape[:-1] + (self.bands_count,), _EPSILON)
+        if len(self._valid_bands):
+            reduced = np.maximum.reduceat(spectra, self._reduce_indices, axis=-1)[..., 0::2]
+            if len(self._open_ended):
+                reduced[..., self._open_ended] = np.maximum(reduced[..., self._open_ended], spectra[..., -1:])
+            maxima[..., self._valid_bands] = np.maximum(reduced, _EPSILON)
+        return maxima
+
+    def _loudness(self, band_maxima):
+        max_amplitude = np.maximum(self.peaks.push(band_maxima), _DEFAULT_MAX_AMPLITUDE)
+
+        # log10 is monotonic so the loudest bin of a band is the band maximum
+        loudness_db = 20 * np.log10((band_maxima + _EPSILON) / (max_amplitude + _EPSILON))
+
+        if self.emma_enabled:
+            self.ema = np.where(self.empty_bands, self.ema, (loudness_db * self.alphas) + (self.ema * (1 - self.alphas)))
+            loudness_db = self.ema.copy()
+
+        loudness_db[self.empty_bands] = -np.inf
+        return loudness_db
+
+    def analyze_frames(self, frames):
+        '''Analyze a (n_slices, slice_size) array with a single 2-D rFFT.
+        Returns a (n_slices, bands_count) WIRE_DTYPE array of band loudness'''
+        slices_count = len(frames)
+        if self._windowed is None or len(self._windowed) < slices_count:
+            self._windowed = np.empty((slices_count, self.slice_size))
+
+        windowed = self._windowed[:slices_count]
+        np.multiply(frames, self.window, out=windowed)
+        spectra = np.abs(np.fft.rfft(windowed, axis=1))
+        band_maxima = self.band_maxima(spectra)
+
+        # The peak history and the EMA depend on the previous slice, so only
+        # this step walks the rows. The levels are emitted in the wire format
+        # (big endian float32) so they can be sent without re-encoding
+        levels = np.empty(band_maxima.shape, dtype=WIRE_DTYPE)
+        for i in range(slices_count):
+            levels[i] = self._loudness(band_maxima[i])
+        return levels
+
+    def analyze_block(self, samples):
+        '''Split a mono block in back to back slices and analyze all of them at once.
+        A trailing partial slice (end of a file) is zero padded'''
+        slices_count, remainder = divmod(len(samples), self.slice_size)
+        if remainder:
+            padded = np.zeros((slices_count + 1) * self.slice_size)
+            padded[:len(samples)] = samples
+            samples = padded
+            slices_count += 1
+
+        if not slices_count:
+            return np.empty((0, self.bands_count), dtype=WIRE_DTYPE)
+
+        return self.analyze_frames(samples.reshape(slices_count, self.slice_size))
+
+    def process(self, samples):
+        '''Analyze the next block of a mono stream, returns one band vector per slice/hop'''
+        if self.sliding_window is None:
+            return self.analyze_block(samples)
+
+        return self.analyze_frames(self.sliding_window.push(samples))
+
+def sample_dtype(sample_width):
     if sample_width == 2:
-        _dtype = np.int16
-    else:
-        _dtype = np.int8
-
-    np_data = np.frombuffer(audio_frames, dtype=_dtype)
-    
-    # If stereo, convert to mono
-    if channels == 2:
-        np_data = np_data.reshape(-1, 2)
-        np_data = np_data.mean(axis=1)
-
-    start = 0
-    end = slice_size
-    
-    while True:
-        frames = np_data[start:end]
-        hann_window = np.hamming(len(frames))
-        frames = frames * hann_window
-
-        if len(frames) == 0:
-            break
-
-        fft_real = np.fft.fft(np_data)
-        fft_result = np.abs(fft_real)
-        fft_freqs = np.fft.fftfreq(len(fft_result), 1.0 / audio_framerate)
-        
-        bin_maxima = np.zeros(len(frequency_bands))
-
-        for i, (low, high, max_amplitudes, ema, alpha) in enumerate(frequency_bands):
-            bin_indices = np.where((fft_freqs >= low) & (fft_freqs < high))[0]
-            
-            if bin_indices.size == 0:
-                bin_maxima[i] = -np.inf
-                continue
-
-            amplitudes = np.abs(fft_result[bin_indices])
-            
-            max_band_amplitude = max(np.max(amplitudes), _EPSILON)
-            
-            max_amplitudes.append(max_band_amplitude)
-            if len(max_amplitudes) > _MAX_AMPLITUDE_BIN_SIZE:
-                max_amplitudes.pop(0)
-                
-            max_amplitude = max(np.max(max_amplitudes), _DEFAULT_MAX_AMPLITUDE)
-
-            loudness_db = 20 * np.log10((amplitudes + _EPSILON) / (max_amplitude + _EPSILON))
-            max_loudness = np.max(loudness_db)
-            
-            if _emma_enabled:
-                ema[0] = (max_loudness * alpha) + (ema[0] * (1 - alpha))
-                bin_maxima[i] = ema[0]
-            else:
-                bin_maxima[i] = max_loudness
-            
-        _fft_queue.put(bin_maxima)
-        start = end
-        end += slice_size
-
-def init(fft_queue, enable_emma, emma_alpha):
-    global _fft_queue, _emma_enabled, _DEFAULT_ALPHA
-    _fft_queue = fft_queue
-    _emma_enabled = enable_emma
-    _DEFAULT_ALPHA = emma_alpha
\ No newline at end of file
+        return np.dtype('<i2')
+    return np.dtype(np.int8)
+
+def sample_frames(audio_frames, sample_width, channels):
+    '''Raw interleaved audio bytes to a (samples, channels) view'''
+    return np.frombuffer(audio_frames, dtype=sample_dtype(sample_width)).reshape(-1, channels)
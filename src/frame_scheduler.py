@@ -0,0 +1,65 @@
+'''Presentation of the rasterized frames at the time they belong to, instead of as fast as they are queued'''
+
+import time
+from collections import deque
+import numpy as np
+
+_REPORT_INTERVAL = 10 # seconds between two presentation reports
+_DRIFT_SAMPLES = 10000 # presentation drifts kept between two reports
+
+class FrameScheduler:
+    '''Frames wait here with their display time (seconds since epoch, the clock of the
+    capture timestamps). The render loop takes the latest frame that is due and the
+    older ones are dropped, so a slow renderer or a burst of late FFT frames skips
+    ahead instead of falling behind the audio'''
+
+    def __init__(self, report_interval = _REPORT_INTERVAL):
+        self.frames = deque()
+        self.presented = 0
+        self.dropped = 0
+        # How late the presented frames were shown
+        self.drifts = deque(maxlen=_DRIFT_SAMPLES)
+        self.report_interval = report_interval
+        self._last_report = time.time()
+
+    def __len__(self):
+        return len(self.frames)
+
+    def push(self, frames, display_times):
+        '''Queue frames to display at display_times, in increasing order'''
+        self.frames.extend(zip(display_times, frames))
+
+    def next_frame(self, now = None):
+        '''The latest due frame, None when no new frame is due yet'''
+        if now is None:
+            now = time.time()
+
+        frame = None
+        display_time = None
+        while len(self.frames) and self.frames[0][0] <= now:
+            if frame is not None:
+                self.dropped += 1
+            display_time, frame = self.frames.popleft()
+
+        if frame is not None:
+            self.presented += 1
+            self.drifts.append(now - display_time)
+
+        if self.report_interval and now - self._last_report >= self.report_interval:
+            self._last_report = now
+            print(f"Animation. {self.stats()}")
+            self.reset_stats()
+
+        return frame
+
+    def stats(self):
+        drift = "n/a"
+        if len(self.drifts):
+            p50, p99 = np.percentile(self.drifts, [50, 99]) * 1000
+            drift = f"{p50:.1f}ms p50, {p99:.1f}ms p99"
+        return f"Presented frames: {self.presented}. Dropped frames: {self.dropped}. Queued frames: {len(self.frames)}. Drift: {drift}"
+
+    def reset_stats(self):
+        self.presented = 0
+        self.dropped = 0
+        self.drifts.clear()
@@ -0,0 +1,141 @@
+'''LED matrix outputs driven by the (cols, rows) pixel masks of the animation, without a window.
+Every frame is encoded in place into buffers allocated once'''
+
+import os
+import stat
+import socket
+import struct
+import numpy as np
+
+# Same colors as the window: green rows, then yellow, the top one red
+GREEN = (0, 255, 0)
+YELLOW = (255, 255, 0)
+RED = (255, 0, 0)
+
+ARTNET_PORT = 6454
+ARTNET_ID = b'Art-Net\x00'
+ARTNET_OP_DMX = 0x5000
+ARTNET_VERSION = 14
+# id, opcode (the only little endian field)
+ARTNET_ID_FMT = '<8sH'
+# protocol version, sequence, physical port, sub-net/universe, net, data length
+ARTDMX_FMT = '>HBBBBH'
+ARTDMX_SEQUENCE_OFFSET = struct.calcsize(ARTNET_ID_FMT) + 2
+ARTDMX_HEADER_SIZE = struct.calcsize(ARTNET_ID_FMT) + struct.calcsize(ARTDMX_FMT)
+# 170 RGB LEDs, a LED never spans two universes
+UNIVERSE_CHANNELS = 510
+
+def row_color(row):
+    if row < 5:
+        return GREEN
+    if row < 7:
+        return YELLOW
+    return RED
+
+class PixelEncoder:
+    '''Packs a pixel mask into an RGB frame buffer, 3 bytes per LED. LEDs are wired
+    column after column from the bottom one, serpentine strips run every other
+    column from the top'''
+
+    def __init__(self, cols, rows, serpentine = False):
+        self.cols = cols
+        self.rows = rows
+        self.serpentine = serpentine
+        self.buffer = bytearray(cols * rows * 3)
+
+        self._colors = np.array([[row_color(row) for row in range(rows)]] * cols, dtype=np.uint8)
+        pixels = np.frombuffer(self.buffer, dtype=np.uint8).reshape(cols, rows, 3)
+        if serpentine:
+            # (views of the buffer, columns of the mask) with the rows of the odd columns reversed
+            self._targets = [(pixels[0::2], slice(0, None, 2)), (pixels[1::2, ::-1], slice(1, None, 2))]
+        else:
+            self._targets = [(pixels, slice(None))]
+
+    def encode(self, pixels):
+        '''Returns the buffer, overwritten by the next call'''
+        pixels = np.asarray(pixels, dtype=bool)
+        if pixels.shape != (self.cols, self.rows):
+            raise ValueError(f"Expected a {self.cols}x{self.rows} pixel mask, got {pixels.shape}")
+
+        for target, cols in self._targets:
+            np.multiply(self._colors[cols], pixels[cols, :, np.newaxis], out=target)
+        return self.buffer
+
+class RgbSink:
+    '''Writes one packed RGB frame per animation frame to a file, a named pipe or a device node.
+    Seekable character devices (frame buffers) are overwritten from the start on every frame,
+    files and pipes get the frames back to back'''
+
+    def __init__(self, path, cols, rows, serpentine = False):
+        self.path = path
+        self.encoder = PixelEncoder(cols, rows, serpentine)
+        # Opening a named pipe waits for its reader
+        self.file = open(path, 'wb', buffering=0)
+        self.rewind = stat.S_ISCHR(os.fstat(self.file.fileno()).st_mode) and self.file.seekable()
+
+    def write(self, pixels):
+        data = self.encoder.encode(pixels)
+        if self.rewind:
+            self.file.seek(0)
+        self.file.write(data)
+
+    def close(self):
+        self.file.close()
+
+    def __str__(self):
+        return f"RGB frames to {self.path}"
+
+class ArtNetSink:
+    '''Sends the RGB frame as ArtDMX packets, one universe per 170 LEDs starting from `universe`'''
+
+    def __init__(self, target, cols, rows, universe = 0, serpentine = False):
+        self.target = target
+        self.universe = universe
+        self.encoder = PixelEncoder(cols, rows, serpentine)
+        self.sequence = 0
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+
+        # (packet, its data, the part of the frame buffer it carries) of every universe
+        frame = memoryview(self.encoder.buffer)
+        self.packets = []
+        for index, offset in enumerate(range(0, len(frame), UNIVERSE_CHANNELS)):
+            channels = frame[offset:offset + UNIVERSE_CHANNELS]
+            # The DMX data length must be even
+            length = len(channels) + len(channels) % 2
+            packet = bytearray(ARTDMX_HEADER_SIZE + length)
+            port_address = universe + index
+            struct.pack_into(ARTNET_ID_FMT, packet, 0, ARTNET_ID, ARTNET_OP_DMX)
+            struct.pack_into(ARTDMX_FMT, packet, struct.calcsize(ARTNET_ID_FMT), ARTNET_VERSION, 0, 0,
+                             port_address & 0xFF, (port_address >> 8) & 0x7F, length)
+            self.packets.append((packet, memoryview(packet)[ARTDMX_HEADER_SIZE:ARTDMX_HEADER_SIZE + len(channels)], channels))
+
+    def write(self, pixels):
+        self.encoder.encode(pixels)
+        # 0 means no sequence, it wraps from 255 to 1
+        self.sequence = self.sequence % 255 + 1
+        for packet, data, channels in self.packets:
+            packet[ARTDMX_SEQUENCE_OFFSET] = self.sequence
+            data[:] = channels
+            self.sock.sendto(packet, self.target)
+
+    def close(self):
+        self.sock.close()
+
+    def __str__(self):
+        return f"Art-Net universes {self.universe}-{self.universe + len(self.packets) - 1} to {self.target[0]}:{self.target[1]}"
+
+def open_sink(spec, cols, rows, serpentine = False):
+    '''rgb:PATH or artnet:HOST[:PORT][/UNIVERSE]'''
+    kind, _, target = spec.partition(':')
+    if kind == 'rgb' and target:
+        return RgbSink(target, cols, rows, serpentine)
+
+    if kind == 'artnet' and target:
+        target, _, universe = target.partition('/')
+        host, _, port = target.partition(':')
+        address = (socket.gethostbyname(host), int(port) if port else ARTNET_PORT)
+        return ArtNetSink(address, cols, rows, int(universe) if universe else 0, serpentine)
+
+    raise ValueError(f"Invalid LED output {spec}, expected rgb:PATH or artnet:HOST[:PORT][/UNIVERSE]")
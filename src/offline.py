@@ -0,0 +1,94 @@
+'''Analyze WAV files as fast as possible, without playback or any audio device'''
+
+import os
+import time
+import numpy as np
+from . import fft
+from . import audio_source
+from . import streams
+from .wav_file import WavFile
+
+_BLOCK_SECONDS = 30 # audio read and analyzed at once
+
+def output_dtype(bands_count):
+    '''One record per band vector. The timestamp is the offset in seconds from the start of
+    the file at which the live server would have sent the frame (end of the analyzed hop)'''
+    return np.dtype([('timestamp', '<f8'), ('levels', '<f4', (bands_count,))])
+
+def output_path(output, index):
+    '''The first file is written to output, file N to output-N'''
+    if index == 0:
+        return output
+    root, ext = os.path.splitext(output)
+    return f"{root}-{index}{ext}"
+
+def analyze_wav(source, options):
+    '''Returns the analyzer, the number of band vectors the file gives and a generator of
+    (timestamps, levels) blocks'''
+    wav = WavFile(source)
+    framerate = wav.framerate
+
+    hop = audio_source.samples_per_chunk(framerate, options['sample_rate'])
+    analyzer = streams.create_analyzer(hop, framerate, options)
+
+    # A multiple of the hop, so only the end of the file is zero padded in block mode
+    block_size = max(int(_BLOCK_SECONDS * framerate) // hop, 1) * hop
+    frames_count = analyzer.frames_count(wav.frames_count)
+
+    def blocks():
+        analyzed = 0
+        try:
+            for data in wav.blocks(block_size):
+                levels = analyzer.process(analyzer.downmix(data))
+                timestamps = (np.arange(analyzed, analyzed + len(levels)) + 1) * (hop / framerate)
+                analyzed += len(levels)
+                yield timestamps, levels
+        finally:
+            wav.close()
+
+    return analyzer, frames_count, blocks()
+
+def write_npy(output, analyzer, frames_count, blocks):
+    '''Stream the records to a memory-mapped .npy, the matrix never has to fit in memory'''
+    records = np.lib.format.open_memmap(output, mode='w+', dtype=output_dtype(analyzer.bands_count), shape=(frames_count,))
+    written = 0
+    for timestamps, levels in blocks:
+        count = len(levels)
+        records['timestamp'][written:written + count] = timestamps
+        records['levels'][written:written + count] = levels
+        written += count
+
+    records.flush()
+    return written
+
+def write_npz(output, analyzer, frames_count, blocks, bands):
+    timestamps = np.empty(frames_count)
+    levels = np.empty((frames_count, analyzer.bands_count), dtype=np.float32)
+    written = 0
+    for block_timestamps, block_levels in blocks:
+        count = len(block_levels)
+        timestamps[written:written + count] = block_timestamps
+        levels[written:written + count] = block_levels
+        written += count
+
+    np.savez(output, timestamps=timestamps[:written], levels=levels[:written],
+             sample_rate=analyzer.audio_framerate / analyzer.hop,
+             bands=np.array([band[:2] for band in bands]))
+    return written
+
+def analyze_file(source, output, options):
+    '''Analyze source and write the band matrix to output (.npz or .npy)'''
+    started = time.perf_counter()
+    analyzer, frames_count, blocks = analyze_wav(source, options)
+
+    if output.endswith('.npz'):
+        written = write_npz(output, analyzer, frames_count, blocks, options.get('bands') or fft.frequency_bands)
+    elif output.endswith('.npy'):
+        written = write_npy(output, analyzer, frames_count, blocks)
+    else:
+        raise ValueError(f"Unsupported output {output}, use .npz or .npy")
+
+    elapsed = time.perf_counter() - started
+    duration = written * analyzer.hop / analyzer.audio_framerate
+    print(f"{source}: {written} frames ({duration:.1f}s of audio) written to {output} in {elapsed:.2f}s")
+    return written
@@ -0,0 +1,183 @@
+'''Decimation ahead of the analysis, so high rate inputs don't make the FFT bigger than the bands need'''
+
+import numpy as np
+from . import fft
+
+# Part of the decimated Nyquist frequency that can be used by the bands
+_PASSBAND = 0.9
+# Attenuation of what would alias into the bands, more than the range the levels are shown with
+_ATTENUATION_DB = 60
+# The hop is a multiple of 32 samples, power of two factors up to 32 always divide it
+MAX_FACTOR = 32
+
+def lowpass(factor, passband):
+    '''Kaiser windowed sinc anti-aliasing filter for a decimation by factor, keeping
+    frequencies up to passband (cycles per sample). Aliases only have to be kept out of
+    the passband, so the transition band goes up to 1 / factor - passband and the
+    filter is only as long as that width needs. Its length is a multiple of factor'''
+    transition = 1 / factor - 2 * passband
+    beta = 0.1102 * (_ATTENUATION_DB - 8.7)
+    taps_count = int(np.ceil((_ATTENUATION_DB - 7.95) / (2.285 * 2 * np.pi * transition))) + 1
+    taps_count = -(-taps_count // factor) * factor
+
+    n = np.arange(taps_count) - (taps_count - 1) / 2
+    cutoff = 0.5 / factor
+    taps = 2 * cutoff * np.sinc(2 * cutoff * n) * np.kaiser(taps_count, beta)
+    return taps / taps.sum()
+
+def max_rate_factor(framerate, max_frequency):
+    '''Largest power of two decimation keeping max_frequency in the passband'''
+    factor = 1
+    while factor < MAX_FACTOR and framerate / (factor * 2) / 2 * _PASSBAND >= max_frequency:
+        factor *= 2
+    return factor
+
+class Decimator:
+    '''Low-pass filters a stream and keeps every factor-th sample.
+
+    Only the kept samples are computed (polyphase form): the filter is split in
+    `factor` sub-filters, each one runs on one phase of the input at the output
+    rate and their sum is the filtered and downsampled signal. The samples the
+    next output still needs are carried over, a stream of N samples gives
+    ceil(N / factor) outputs whatever the block sizes'''
+
+    def __init__(self, factor, passband = None):
+        '''passband is the highest frequency to keep in cycles per (input) sample'''
+        if passband is None:
+            passband = 0.5 / factor * _PASSBAND
+
+        self.factor = factor
+        taps = lowpass(factor, passband)
+        # Output n is the dot product of the reversed taps with the input from n * factor,
+        # sub-filter p holds the reversed taps p, p + factor, p + 2 * factor...
+        self.phases = [taps[::-1][p::factor].copy() for p in range(factor)]
+        self.taps_count = len(taps)
+        self._buffer = np.zeros(2 * self.taps_count)
+        # Zeros before the first sample, the first output is centered near it
+        self._buffered = self.taps_count - 1
+        self._output = np.empty(0)
+
+    def process(self, samples):
+        '''Returns the decimated samples, the array is reused by the next call'''
+        needed = self._buffered + len(samples)
+        if len(self._buffer) < needed:
+            buffer = np.empty(needed + self.taps_count)
+            buffer[:self._buffered] = self._buffer[:self._buffered]
+            self._buffer = buffer
+
+        buffer = self._buffer
+        buffer[self._buffered:needed] = samples
+
+        count = max((needed - self.taps_count) // self.factor + 1, 0)
+        if len(self._output) < count:
+            self._output = np.empty(count)
+        output = self._output[:count]
+
+        if count:
+            output.fill(0)
+            for p, sub_filter in enumerate(self.phases):
+                output += np.correlate(buffer[p:needed:self.factor], sub_filter, 'valid')[:count]
+
+        # Keep what the next window needs
+        consumed = count * self.factor
+        self._buffered = needed - consumed
+        buffer[:self._buffered] = buffer[consumed:needed]
+        return output
+
+class DecimatingAnalyzer:
+    '''fft.Analyzer behind a decimation stage, with the same interface.
+
+    The audio is decimated `factor` times before the analysis. With a low_factor
+    the bands that fit under the rate decimated low_factor times more are analyzed
+    on that signal (multirate). Their FFT has the same size, so it spans low_factor
+    times more audio and resolves the bass low_factor times finer. The high bands
+    don't need that resolution, their window is low_factor times shorter (down to
+    the hop) which pays for the second FFT. Every band keeps its own peak history and EMA, so splitting them doesn't change
+    the normalization'''
+
+    def __init__(self, samples_count, framerate, options, factor, low_factor = 1, bands = None):
+        if bands is None:
+            bands = fft.frequency_bands
+
+        self.factor = factor
+        self.low_factor = low_factor
+        self.bands_count = len(bands)
+        self.audio_framerate = framerate / factor
+        self.hop = samples_count // factor
+        slice_size = max(options['stft_window'] // factor, self.hop)
+
+        max_frequency = max(band[1] for band in bands)
+        self.decimator = Decimator(factor, max_frequency / framerate) if factor > 1 else None
+
+        low_rate = self.audio_framerate / low_factor
+        self.low_bands = [i for i, band in enumerate(bands) if low_factor > 1 and band[1] <= low_rate / 2 * _PASSBAND]
+        self.high_bands = [i for i in range(len(bands)) if i not in self.low_bands]
+
+        # With two analyzers both go through a sliding window so they always give
+        # one band vector per completed hop and stay in step
+        multirate = len(self.low_bands) > 0
+        self.analyzers = []
+        if len(self.high_bands):
+            high_slice_size = max(slice_size // low_factor, self.hop) if multirate else slice_size
+            self.analyzers.append((self.high_bands, None, self._analyzer_for(
+                high_slice_size, self.audio_framerate, [bands[i] for i in self.high_bands], self.hop, options, multirate)))
+        if multirate:
+            low_max_frequency = max(bands[i][1] for i in self.low_bands)
+            self.analyzers.append((self.low_bands, Decimator(low_factor, low_max_frequency / self.audio_framerate), self._analyzer_for(
+                slice_size, low_rate, [bands[i] for i in self.low_bands], self.hop // low_factor, options, True)))
+
+        self.streaming = any(analyzer.sliding_window is not None for _, _, analyzer in self.analyzers)
+        self.empty_bands = np.zeros(self.bands_count, dtype=bool)
+        for band_indices, _, analyzer in self.analyzers:
+            self.empty_bands[band_indices] = analyzer.empty_bands
+        self._pending = [None] * len(self.analyzers)
+
+    @staticmethod
+    def _analyzer_for(slice_size, framerate, bands, hop, options, streaming):
+        return fft.Analyzer(slice_size, framerate, bands,
+                            peak_window=options['peak_window'],
+                            hop=hop,
+                            enable_emma=options['enable_emma'],
+                            emma_alpha=options['emma_alpha'],
+                            streaming=streaming)
+
+    def downmix(self, frames):
+        return self.analyzers[0][2].downmix(frames)
+
+    def frames_count(self, samples_count):
+        '''Band vectors given by a finite stream of samples_count input samples. Every
+        decimator gives ceil(samples / factor) samples, the analyzers count their own
+        band vectors and only as many as the fewest of them are merged'''
+        if self.decimator is not None:
+            samples_count = -(-samples_count // self.factor)
+
+        counts = []
+        for _, decimator, analyzer in self.analyzers:
+            analyzed = -(-samples_count // decimator.factor) if decimator is not None else samples_count
+            counts.append(analyzer.frames_count(analyzed))
+        return min(counts)
+
+    def process(self, samples):
+        if self.decimator is not None:
+            samples = self.decimator.process(samples)
+
+        outputs = []
+        for i, (_, decimator, analyzer) in enumerate(self.analyzers):
+            levels = analyzer.process(decimator.process(samples) if decimator is not None else samples)
+            # Only at the end of a stream can the analyzers be a band vector apart,
+            # the extra ones wait for the next call
+            if self._pending[i] is not None:
+                levels = np.concatenate([self._pending[i], levels])
+                self._pending[i] = None
+            outputs.append(levels)
+
+        count = min(len(levels) for levels in outputs)
+        if len(outputs) == 1:
+            return outputs[0]
+
+        result = np.empty((count, self.bands_count), dtype=fft.WIRE_DTYPE)
+        for i, ((band_indices, _, _), levels) in enumerate(zip(self.analyzers, outputs)):
+            result[:, band_indices] = levels[:count]
+            if len(levels) > count:
+                self._pending[i] = levels[count:].copy()
+        return result
@@ -1,9 +1,11 @@
 import time
 import pygame
 import sys
+import numpy as np
 from collections import deque
+from .frame_scheduler import FrameScheduler
+from .animation_utils import LED_ROWS
 
-LED_ROWS = 8
 LED_COLS = 10
 SCREEN_PADDING = 100
 
@@ -19,6 +21,8 @@ red = (255, 0, 0)
 
 led_matrix = []
 raster_queue = deque()
+# Pre-rendered (off, on) LED surfaces of every color
+led_surfaces = {}
 
 class Led():
     WIDTH = 40
@@ -31,16 +35,30 @@ class Led():
         self.y = y
         self.color = color
         self.visible = visible
+        self.rect = pygame.Rect(x, y, Led.WIDTH, Led.HEIGHT)
         
     def render(self):
-        color = self.color if self.visible else black
-        pygame.draw.rect(screen, color, (self.x, self.y, Led.WIDTH, Led.HEIGHT))
+        '''Blits the LED and returns the rect it covers'''
+        return screen.blit(led_surface(self.color, self.visible), self.rect)
             
+def led_surface(color, visible):
+    if color not in led_surfaces:
+        surfaces = []
+        for fill in (black, color):
+            surface = pygame.Surface((Led.WIDTH, Led.HEIGHT)).convert()
+            surface.fill(fill)
+            surfaces.append(surface)
+        led_surfaces[color] = surfaces
+    return led_surfaces[color][1 if visible else 0]
 
-def init(animation_framerate):
-    global screen, clock, led_matrix, framerate
+
+def init(animation_framerate, cols = None):
+    global screen, clock, led_matrix, framerate, LED_COLS
 
     framerate = animation_framerate
+    # One column per frequency band
+    if cols is not None:
+        LED_COLS = cols
 
     # Screen dimensions
     screen_width = LED_COLS * (Led.WIDTH + 2 * Led.SPACING_HORIZONTAL) + SCREEN_PADDING
@@ -83,35 +101,52 @@ def init(animation_framerate):
         x += Led.WIDTH + 2 * Led.SPACING_HORIZONTAL
         y = bottom_left[1]
         
-def mainloop(rasterize_fn):
+def mainloop(rasterize_fn, present_fn = None):
+    '''present_fn is also given every frame that is displayed'''
     # Main game loop
     running = True
     last_run = 0
-    pixels_queue = deque()
+    frames = FrameScheduler()
+    # Last drawn (cols, rows) mask, None when the whole matrix must be redrawn
+    drawn = None
     while running:
         # Event handling
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
                 running = False
+            elif event.type == pygame.VIDEOEXPOSE:
+                drawn = None
                 
-        rasterize_fn(pixels_queue)
+        rasterize_fn(frames)
 
-        try:
-            pixels = pixels_queue.pop()
-        except IndexError:
+        # The latest frame that is due, the display stays as is until there is one
+        pixels = frames.next_frame()
+        if pixels is None:
             clock.tick(framerate)
             continue
         
-        # Draw the leds
-        for i in range(0, LED_COLS):
-            for j in range(0, LED_ROWS):
-                led_state = pixels[i][j]
-                led = led_matrix[i][j]
-                led.visible = led_state
-                led.render()
+        # Only redraw the leds that changed since the last frame
+        pixels = np.asarray(pixels, dtype=bool)
+        if drawn is None:
+            changed = np.argwhere(np.ones_like(pixels))
+        else:
+            changed = np.argwhere(pixels != drawn)
+
+        dirty_rects = []
+        for i, j in changed:
+            led = led_matrix[i][j]
+            led.visible = pixels[i, j]
+            dirty_rects.append(led.render())
 
         # Update the display
-        pygame.display.flip()
+        if drawn is None:
+            pygame.display.flip()
+        elif dirty_rects:
+            pygame.display.update(dirty_rects)
+        drawn = pixels.copy()
+
+        if present_fn is not None:
+            present_fn(pixels)
 
         # Cap the frame rate at 60 frames per second
         clock.tick(framerate)
@@ -0,0 +1,154 @@
+'''Band vectors shared with local processes through a shared memory ring buffer.
+
+Layout: a header of HEADER_FIELDS uint64 values, one float64 timestamp per slot
+and one float32 band vector per slot. The writer bumps the generation counter
+before and after every write (seqlock), an odd generation means a write is in
+progress. write_index is the total number of frames written, frame i lives in
+slot i % capacity until capacity more frames are written'''
+
+import time
+import numpy as np
+from multiprocessing import shared_memory
+
+MAGIC = 0x46465452 # "FFTR"
+VERSION = 1
+
+# Header fields
+_MAGIC = 0
+_VERSION = 1
+_GENERATION = 2
+_WRITE_INDEX = 3
+_BANDS_COUNT = 4
+_SAMPLE_RATE = 5
+_CAPACITY = 6
+HEADER_FIELDS = 8
+
+DEFAULT_CAPACITY = 256
+
+def _layout(bands_count, capacity):
+    header_size = HEADER_FIELDS * 8
+    timestamps_size = capacity * 8
+    data_size = capacity * bands_count * 4
+    return header_size, timestamps_size, header_size + timestamps_size + data_size
+
+def _map(buffer, bands_count, capacity):
+    header_size, timestamps_size, _ = _layout(bands_count, capacity)
+    header = np.ndarray((HEADER_FIELDS,), dtype=np.uint64, buffer=buffer)
+    timestamps = np.ndarray((capacity,), dtype=np.float64, buffer=buffer, offset=header_size)
+    data = np.ndarray((capacity, bands_count), dtype=np.float32, buffer=buffer, offset=header_size + timestamps_size)
+    return header, timestamps, data
+
+class ShmRingWriter:
+    '''Creates the shared memory block and appends band vectors to it'''
+
+    def __init__(self, name, bands_count, sample_rate, capacity = DEFAULT_CAPACITY):
+        _, _, size = _layout(bands_count, capacity)
+        self.name = name
+        self.capacity = capacity
+        self._shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        self._header, self._timestamps, self._data = _map(self._shm.buf, bands_count, capacity)
+
+        self._header[:] = 0
+        self._header[_MAGIC] = MAGIC
+        self._header[_VERSION] = VERSION
+        self._header[_BANDS_COUNT] = bands_count
+        self._header[_SAMPLE_RATE] = sample_rate
+        self._header[_CAPACITY] = capacity
+
+    def write(self, values, timestamp = None):
+        if timestamp is None:
+            timestamp = time.time()
+
+        index = int(self._header[_WRITE_INDEX])
+        slot = index % self.capacity
+
+        self._header[_GENERATION] += 1
+        self._timestamps[slot] = timestamp
+        self._data[slot] = values
+        self._header[_WRITE_INDEX] = index + 1
+        self._header[_GENERATION] += 1
+
+    def close(self):
+        self._header = self._timestamps = self._data = None
+        self._shm.close()
+        self._shm.unlink()
+
+class ShmRingReader:
+    '''Maps a ring created by ShmRingWriter, the frames are NumPy views into the shared memory.
+
+    A view stays valid until the writer wraps around the ring (capacity frames later),
+    use is_valid() or copy the frame if it's kept for longer'''
+
+    def __init__(self, name):
+        # The writer owns the block, don't let the resource tracker unlink it when this process exits
+        try:
+            self._shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # Python < 3.13
+            from multiprocessing import resource_tracker
+            self._shm = shared_memory.SharedMemory(name=name)
+            resource_tracker.unregister(self._shm._name, 'shared_memory')
+
+        header = np.ndarray((HEADER_FIELDS,), dtype=np.uint64, buffer=self._shm.buf)
+        if header[_MAGIC] != MAGIC or header[_VERSION] != VERSION:
+            self._shm.close()
+            raise ValueError(f"{name} is not a FFT ring buffer")
+
+        self.bands_count = int(header[_BANDS_COUNT])
+        self.sample_rate = int(header[_SAMPLE_RATE])
+        self.capacity = int(header[_CAPACITY])
+        self._header, self._timestamps, self._data = _map(self._shm.buf, self.bands_count, self.capacity)
+
+    @property
+    def write_index(self):
+        '''Number of frames written so far'''
+        return int(self._header[_WRITE_INDEX])
+
+    def is_valid(self, index):
+        '''Whether frame index is still in the ring'''
+        write_index = self.write_index
+        return index < write_index and write_index - index <= self.capacity
+
+    def frame(self, index):
+        '''(timestamp, band vector view) of frame index, None if it was already overwritten'''
+        while True:
+            generation = int(self._header[_GENERATION])
+            if generation & 1:
+                continue
+
+            if not self.is_valid(index):
+                return None
+
+            slot = index % self.capacity
+            timestamp = float(self._timestamps[slot])
+            values = self._data[slot]
+
+            if int(self._header[_GENERATION]) == generation:
+                return timestamp, values
+
+    def latest(self):
+        '''(index, timestamp, band vector view) of the most recent frame, None if nothing was written'''
+        index = self.write_index - 1
+        if index < 0:
+            return None
+
+        frame = self.frame(index)
+        if frame is None:
+            return None
+        return (index,) + frame
+
+    def wait(self, index, timeout = None, poll_interval = 0.0005):
+        '''Wait until frame index is written. Returns the write index, None on timeout'''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            write_index = self.write_index
+            if write_index > index:
+                return write_index
+
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            time.sleep(poll_interval)
+
+    def close(self):
+        self._header = self._timestamps = self._data = None
+        self._shm.close()
@@ -0,0 +1,123 @@
+import queue
+import threading
+import multiprocessing
+import numpy as np
+from . import fft
+from . import audio_source
+from . import resample
+
+def create_analyzer(samples_count, framerate, options):
+    '''samples_count is the number of samples between two analyses, with a STFT window
+    configured it becomes the hop and the whole window is analyzed instead.
+    With decimation or multirate enabled the analyzer sits behind a decimation stage'''
+    bands = options.get('bands') or fft.frequency_bands
+    factor = 1
+    if options.get('decimate'):
+        factor = resample.max_rate_factor(framerate, max(band[1] for band in bands))
+
+    # Both factors must divide the hop
+    low_factor = min(options.get('multirate') or 1, resample.MAX_FACTOR // factor)
+    if factor > 1 or low_factor > 1:
+        return resample.DecimatingAnalyzer(samples_count, framerate, options, factor, low_factor, bands)
+
+    return fft.Analyzer(max(options['stft_window'], samples_count), framerate, bands,
+                        peak_window=options['peak_window'],
+                        hop=samples_count,
+                        enable_emma=options['enable_emma'],
+                        emma_alpha=options['emma_alpha'])
+
+def run_stream(source, source_type, options, fft_queue, stop_event, name = None):
+    '''Analyze one audio source and put one (timestamps, levels) pair per audio chunk on fft_queue.
+    levels is a (slices, bands) block, timestamps the capture time of the last sample of every slice'''
+    prefix = f"[{name}] " if name else ""
+
+    # Open the audio source
+    audio = audio_source.open_audio(source, source_type, options)
+    samples_count = audio.samples_count
+    print(f"{prefix}Audio framerate (hz):", audio.framerate)
+
+    if audio.channels > 1:
+        print(f"{prefix}Audio channels: {audio.channels}. Audio will be converted to mono")
+    else:
+        print(f"{prefix}Mono audio")
+
+    print(f"{prefix}Samples count:", samples_count)
+    print(f"{prefix}Sample width (bits):", audio.sample_width * 8)
+    if options['stft_window'] > samples_count:
+        print(f"{prefix}STFT window (samples): {options['stft_window']}. Hop (samples): {samples_count}")
+
+    analyzer = create_analyzer(samples_count, audio.framerate, options)
+    if analyzer.empty_bands.any():
+        print(f"{prefix}Bands {np.flatnonzero(analyzer.empty_bands).tolist()} don't contain any FFT bin and stay at -inf, use a longer --stft-window")
+    if isinstance(analyzer, resample.DecimatingAnalyzer):
+        print(f"{prefix}Analysis framerate (hz): {analyzer.audio_framerate:g}. Decimation: {analyzer.factor}")
+        if len(analyzer.low_bands):
+            print(f"{prefix}Bands {analyzer.low_bands} analyzed at {analyzer.audio_framerate / analyzer.low_factor:g}hz")
+
+    print(f"{prefix}Started audio worker")
+    overflows = 0
+    hop_duration = samples_count / audio.framerate
+    # Read data
+    try:
+        for data in audio.blocks():
+            levels = analyzer.process(analyzer.downmix(data))
+            captured = audio.capture_time()
+
+            if audio.overflows != overflows:
+                print(f"{prefix}Analysis fell behind, {audio.overflows - overflows} audio frames dropped ({audio.overflows} total)")
+                overflows = audio.overflows
+
+            # One queue item per chunk, each row is the band vector of one slice.
+            # The last slice ends with the chunk, the previous ones one hop earlier each
+            if len(levels):
+                timestamps = captured - np.arange(len(levels) - 1, -1, -1) * hop_duration
+                fft_queue.put((timestamps, levels))
+
+            if stop_event.is_set():
+                break
+    finally:
+        audio.close()
+
+class Supervisor:
+    '''Runs one audio worker per source.
+
+    A single source is analyzed in a thread of the current process. With several
+    sources every one of them gets its own process so the analysis runs on separate
+    cores, the band blocks come back over a multiprocessing queue per stream'''
+
+    def __init__(self, sources, options):
+        self.sources = sources
+        self.options = options
+        self.fft_queues = []
+        self._workers = []
+
+        if len(sources) > 1:
+            self._context = multiprocessing.get_context()
+            self.stop_event = self._context.Event()
+        else:
+            self._context = None
+            self.stop_event = threading.Event()
+
+    def start(self):
+        for i, (source, source_type) in enumerate(self.sources):
+            if self._context is None:
+                fft_queue = queue.Queue()
+                worker = threading.Thread(target=run_stream, args=(source, source_type, self.options, fft_queue, self.stop_event))
+            else:
+                fft_queue = self._context.Queue()
+                worker = self._context.Process(target=run_stream,
+                                               args=(source, source_type, self.options, fft_queue, self.stop_event, f"stream {i}"),
+                                               daemon=True)
+
+            self.fft_queues.append(fft_queue)
+            self._workers.append(worker)
+            worker.start()
+
+    def stop(self, timeout = 2.0):
+        self.stop_event.set()
+        for worker in self._workers:
+            worker.join(timeout)
+
+            # Processes blocked on a full pipe or a device read won't see the stop event
+            if self._context is not None and worker.is_alive():
+                worker.terminate()
@@ -2,165 +2,469 @@ import sys
 import time
 import threading
 import asyncio
-import queue
 import struct
+import functools
+import collections
+import numpy as np
+from . import udp_transport
+from . import encoding
 
-data_queue = queue.Queue()
 stop_event = threading.Event()
 ready_event = threading.Event()
 
 _asyncio_loop = None
 _thread = None
-_server = None
-_clients = []
-_sample_rate = None
-_frequency_bands_count = None
+_channels = []
+_stop_requested = None
+_client_lag_budget = 1.0 # seconds a client write may stay blocked before the client is dropped
+_udp_target = None # (address, port) of the multicast group / broadcast address, None disables UDP
+_db_range = encoding.DEFAULT_DB_RANGE # dB range of the quantized encodings
 
-async def disconnect_clients(clients):
+_CLIENT_QUEUE_SIZE = 2
+_STATS_INTERVAL = 10 # seconds between two client latency reports
+_LATENCY_SAMPLES = 10000 # capture to wire latencies kept per channel between two reports
+
+# Protocol v1: '!bb' config message, bare float32 frames, one ACK byte per frame.
+# A v2 client answers the v1 config with HELLO_MARKER followed by a hello message
+# instead of the ACK byte
+HELLO_MARKER = b'\xf2'
+# version, flags, encoding, frames per message
+HELLO_FMT = '!BBBH'
+# version, flags, FFT sample rate, frequency bands count, frames per message, encoding
+CONFIG_V2_FMT = '!BBHHHB'
+# Follows the v2 config for the quantized encodings: range min and max in centi-dB
+DB_RANGE_FMT = '!hh'
+# version, flags, sequence number of the first frame, capture timestamp of the first frame
+# (seconds since epoch), frequency bands count, frames count. Frame i of a message has
+# sequence number + i, a message can hold fewer frames than requested
+HEADER_V2_FMT = '!BBIdHH'
+
+PROTOCOL_V1 = 1
+PROTOCOL_V2 = 2
+FLAG_NO_ACK = 0x01
+MAX_FRAMES_PER_MESSAGE = 256
+# The v1 band count is a signed byte
+MAX_BANDS_V1 = 127
+
+class Frame:
+    '''One band vector, encoded once per encoding in use and shared by all the client writers'''
+
+    def __init__(self, sequence, timestamp, payloads, frequency_bands_count):
+        self.sequence = sequence
+        self.timestamp = timestamp
+        # encoding -> bytes, the delta encoding maps to (keyframe, delta or None)
+        self.payloads = payloads
+        self.frequency_bands_count = frequency_bands_count
+        self._messages_v2 = {}
+
+    def payload(self, encoding_type = encoding.FLOAT32, keyframe = False):
+        payload = self.payloads[encoding_type]
+        if encoding_type == encoding.DELTA:
+            keyframe_payload, delta_payload = payload
+            return keyframe_payload if keyframe or delta_payload is None else delta_payload
+        return payload
+
+    def message(self, version, encoding_type = encoding.FLOAT32):
+        if version == PROTOCOL_V1:
+            return self.payload()
+
+        # Single frame v2 messages are the same for every client using the same encoding, build them once
+        message = self._messages_v2.get(encoding_type)
+        if message is None:
+            message = pack_message_v2([self], [self.payload(encoding_type)])
+            self._messages_v2[encoding_type] = message
+        return message
+
+def pack_message_v2(frames, payloads):
+    first = frames[0]
+    header = struct.pack(HEADER_V2_FMT, PROTOCOL_V2, 0, first.sequence, first.timestamp, first.frequency_bands_count, len(frames))
+    return header + b''.join(payloads)
+
+class Client:
+    '''A connected client with its own writer task.
+
+    Frames are queued in a small bounded queue, when the client can't keep up
+    the oldest queued frame is dropped so the client always gets the latest one'''
+
+    def __init__(self, reader, writer, version = PROTOCOL_V1, flags = 0, frames_per_message = 1, encoding_type = encoding.FLOAT32):
+        self.reader = reader
+        self.writer = writer
+        self.address = writer.get_extra_info('peername')
+        self.version = version
+        self.acknowledges = not (flags & FLAG_NO_ACK)
+        self.frames_per_message = frames_per_message
+        self.encoding = encoding_type
+        self.last_sequence = None
+        # First frame of the next message, it didn't follow the frames of the previous one
+        self.next_frame = None
+        self.frames = asyncio.Queue(maxsize=max(_CLIENT_QUEUE_SIZE, frames_per_message))
+        self.sent_frames = 0
+        self.dropped_frames = 0
+        self.write_started = None
+        # Send time of every message that wasn't acknowledged yet, clients ACK each message with one byte
+        self.unacked_frames = collections.deque(maxlen=64)
+        self.rtt_ms = None
+        self.rtt_avg_ms = None
+        self.rtt_max_ms = 0
+        self.tasks = []
+
+    def push(self, data):
+        if self.frames.full():
+            self.frames.get_nowait()
+            self.dropped_frames += 1
+        self.frames.put_nowait(data)
+
+    def payload(self, frame):
+        '''Delta frames are relative to the previous frame, after a dropped frame the client gets a keyframe'''
+        keyframe = self.last_sequence is None or frame.sequence != (self.last_sequence + 1) & 0xFFFFFFFF
+        self.last_sequence = frame.sequence
+        return frame.payload(self.encoding, keyframe)
+
+    def acknowledge(self, count, now):
+        for _ in range(count):
+            try:
+                sent = self.unacked_frames.popleft()
+            except IndexError:
+                return
+
+            self.rtt_ms = (now - sent) * 1000
+            self.rtt_max_ms = max(self.rtt_max_ms, self.rtt_ms)
+            if self.rtt_avg_ms is None:
+                self.rtt_avg_ms = self.rtt_ms
+            else:
+                self.rtt_avg_ms = 0.9 * self.rtt_avg_ms + 0.1 * self.rtt_ms
+
+    def stats(self):
+        rtt = f"{self.rtt_avg_ms:.2f}ms avg, {self.rtt_max_ms:.2f}ms max" if self.rtt_avg_ms is not None else "n/a"
+        return f"Sent frames: {self.sent_frames}. Dropped frames: {self.dropped_frames}. RTT: {rtt}"
+
+    def lag(self, now):
+        '''For how long the current write has been blocked, 0 when the client is idle'''
+        if self.write_started is None:
+            return 0
+        return now - self.write_started
+
+class Channel:
+    '''One FFT stream, served to its own clients on its own port'''
+
+    def __init__(self, index, sample_rate, frequency_bands_count, port):
+        self.index = index
+        self.sample_rate = sample_rate
+        self.frequency_bands_count = frequency_bands_count
+        self.port = port
+        # Only touched from the event loop, producers go through publish(). Created on
+        # the server loop, before 3.10 asyncio queues bind to the loop of the thread creating them
+        self.data_queue = None
+        self.sequence = 0
+        # Quantized levels of the previous frame, the base of the delta frames
+        self.last_levels = None
+        self.clients = []
+        self.server = None
+        self.udp = None
+        # Seconds between the audio capture and the TCP write of every frame sent
+        self.latencies = collections.deque(maxlen=_LATENCY_SAMPLES)
+
+    def latency_stats(self):
+        if not len(self.latencies):
+            return None
+
+        p50, p99 = np.percentile(self.latencies, [50, 99]) * 1000
+        return f"Capture to wire latency: {p50:.1f}ms p50, {p99:.1f}ms p99 ({len(self.latencies)} frames)"
+
+def publish(data, channel = 0, timestamp = None):
+    '''Queue a band vector for broadcasting to the clients of a channel.
+    Safe to call from any thread, the broadcaster sleeps until data is handed over.
+    The timestamp (seconds since epoch) is the capture time of the audio, it defaults
+    to the time of the call. It's sent to v2 and UDP clients and used to measure the
+    capture to wire latency'''
+    if _asyncio_loop is None or _asyncio_loop.is_closed():
+        return
+
+    if timestamp is None:
+        timestamp = time.time()
+
+    try:
+        _asyncio_loop.call_soon_threadsafe(enqueue, _channels[channel], (timestamp, data))
+    except RuntimeError:
+        # The loop was closed in between, the server is shutting down
+        pass
+
+def enqueue(channel, item):
+    # Frames published before the server loop started have nowhere to go
+    if channel.data_queue is not None:
+        channel.data_queue.put_nowait(item)
+
+async def disconnect_clients(channel, clients):
     for client in clients:
+        if client not in channel.clients:
+            continue
+
+        channel.clients.remove(client)
+        print(f"Client {client.address} disconnected. {client.stats()}")
+
+        for task in client.tasks:
+            if task is not asyncio.current_task():
+                task.cancel()
+
         try:
-            if client[1].is_closing():
+            if client.writer.is_closing():
                 continue
                
-            client[1].close()
-            await asyncio.wait_for(client[1].wait_closed(), timeout=1)
+            client.writer.close()
+            await asyncio.wait_for(client.writer.wait_closed(), timeout=1)
         except:
             pass
-        finally:
-            _clients.remove(client)
+
+async def client_writer(channel, client):
+    try:
+        while True:
+            if client.next_frame is not None:
+                frame, client.next_frame = client.next_frame, None
+            else:
+                frame = await client.frames.get()
+            frames = [frame]
+            while len(frames) < client.frames_per_message:
+                next_frame = await client.frames.get()
+                # The frames of a message have consecutive sequence numbers, frames dropped
+                # in between end the message early and show up as a gap before the next one
+                if next_frame.sequence != (frames[-1].sequence + 1) & 0xFFFFFFFF:
+                    client.next_frame = next_frame
+                    break
+                frames.append(next_frame)
+
+            if len(frames) == 1 and client.encoding != encoding.DELTA:
+                data = frame.message(client.version, client.encoding)
+            else:
+                data = pack_message_v2(frames, [client.payload(frame) for frame in frames])
+
+            client.write_started = time.time()
+            client.writer.write(data)
+            channel.latencies.extend(client.write_started - frame.timestamp for frame in frames)
+            if client.acknowledges:
+                client.unacked_frames.append(client.write_started)
+            await client.writer.drain()
+            client.write_started = None
+            client.sent_frames += len(frames)
+    except asyncio.CancelledError:
+        pass
+    except Exception as e:
+        print("Error while sending data to client", e)
+        await disconnect_clients(channel, [client])
         
-async def discard_client_responses():
-    '''We don't care about client responses. The only reason for expecting them
+async def client_reader(channel, client):
+    '''We don't care about the content of the client responses. The only reason for expecting them
     is to make sure the client doesn't delay sending the ACK packet after receiving data
-    which in turn would delay the next FFT data packet'''
-    
+    which in turn would delay the next FFT data packet.
+    They are drained as soon as they arrive and used to measure the round trip time.
+    Clients that opted out of ACKs send nothing, the reader only detects the disconnect'''
     try:
         while True:
-            for client in _clients:
-                try:
-                    now = time.time()
-                    await asyncio.wait_for(client[0].readexactly(1), timeout=0.05)
-                    read_duration_ms = (time.time() - now) * 1000
-                    if read_duration_ms > 1:
-                        print('Client response read duration:', read_duration_ms)
-                except asyncio.TimeoutError:
-                    print("Caught timeout error while waiting for client response")
-                except Exception as e:
-                    print("Client disconnected", e)
-                    await disconnect_clients([client])
-            await asyncio.sleep(1)
+            data = await client.reader.read(64)
+            if not data:
+                break
+            client.acknowledge(len(data), time.time())
     except asyncio.CancelledError:
-        pass
+        return
+    except Exception as e:
+        print("Error while reading client response", e)
+
+    await disconnect_clients(channel, [client])
+
+async def report_clients(channel):
+    while True:
+        await asyncio.sleep(_STATS_INTERVAL)
+        for client in channel.clients:
+            print(f"Channel {channel.index} client {client.address}. {client.stats()}")
+
+        latency = channel.latency_stats()
+        if latency is not None:
+            print(f"Channel {channel.index}. {latency}")
+            channel.latencies.clear()
+
+def pack_frame(data):
+    '''Serialize a band vector once, the resulting bytes are shared by all the client writers.
+    Vectors coming from the analyzer are already big endian float32 so this is a single copy'''
+    return encoding.encode_float32(data)
+
+def encode_frame(channel, timestamp, data):
+    '''Encode a band vector once for every encoding used by the clients of the channel'''
+    encodings = {client.encoding for client in channel.clients}
 
-async def broadcast_fft_data():
+    # float32 is always needed, it's the v1 and the UDP format
+    payloads = {encoding.FLOAT32: pack_frame(data)}
+    if encoding.INT16 in encodings:
+        payloads[encoding.INT16] = encoding.encode_int16(data)
+
+    if encodings.intersection(encoding.QUANTIZED_ENCODINGS):
+        levels = encoding.quantize(data, _db_range)
+        payloads[encoding.UINT8] = levels.tobytes()
+        if encoding.DELTA in encodings:
+            delta = encoding.encode_delta(levels, channel.last_levels) if channel.last_levels is not None else None
+            payloads[encoding.DELTA] = (encoding.encode_keyframe(levels), delta)
+        channel.last_levels = levels
+    else:
+        channel.last_levels = None
+
+    frame = Frame(channel.sequence, timestamp, payloads, len(data))
+    channel.sequence = (channel.sequence + 1) & 0xFFFFFFFF
+    return frame
+
+async def broadcast_fft_data(channel):
+    '''Hand every frame to the client writers without waiting for any of them,
+    a slow client only delays (and drops) its own frames'''
     try:
-        last_ms = 0
-        period = 1000 / _sample_rate
-        skip_threshold = period + (period * 0.25)
         while True:
-            try:
-                data = data_queue.get(block=True, timeout=0.001)
-            except queue.Empty:
-                data = None
-                
-            if data is None:
-                await asyncio.sleep(0.001)
-                continue
+            timestamp, data = await channel.data_queue.get()
+            frame = encode_frame(channel, timestamp, data)
+            lagging_clients = []
 
-            data = struct.pack(f'!{len(data)}f', *data.tolist())
-            disconnected_clients = []
+            now = time.time()
+            if channel.udp is not None:
+                channel.udp.send(frame.payload(), timestamp)
 
-            for client in _clients:
-                try:
-                    now = time.time()
-                    diff = round((now - last_ms) * 1000)
-                    last_ms = now
-                    
-                    if diff > skip_threshold:
-                        print(f"Skipping frame. Expected interval: {skip_threshold}ms. Actual: {diff}")    
-                        continue
-
-                    client[1].write(data)
-                    await client[1].drain()
-                except asyncio.TimeoutError as e:
-                    print("Timeout error", e)
+            for client in channel.clients:
+                if client.lag(now) > _client_lag_budget:
+                    lagging_clients.append(client)
                     continue
-                except Exception as e:
-                    disconnected_clients.append(client)
-                    print("Client disconnected", e)
+
+                client.push(frame)
                     
-            # remove any disconnected clients
-            if len(disconnected_clients):
-                await disconnect_clients(disconnected_clients)
+            # remove the clients that stopped reading
+            if len(lagging_clients):
+                for client in lagging_clients:
+                    print(f"Client {client.address} blocked for more than {_client_lag_budget * 1000:.0f}ms")
+                await disconnect_clients(channel, lagging_clients)
 
     except asyncio.CancelledError:
-        await disconnect_clients(_clients)
+        await disconnect_clients(channel, list(channel.clients))
 
-async def handle_client(reader, writer):
-    print(_sample_rate, _frequency_bands_count)
+async def handle_client(channel, reader, writer):
+    print(channel.sample_rate, channel.frequency_bands_count)
     try:
-        writer.write(struct.pack('!bb', _sample_rate, _frequency_bands_count))
+        # v1 values are signed bytes, v2 clients get the real values in the v2 config.
+        # A band count that doesn't fit is sent as 0, v1 clients can't frame the data and are refused
+        bands_count_v1 = channel.frequency_bands_count if channel.frequency_bands_count <= MAX_BANDS_V1 else 0
+        writer.write(struct.pack('!bb', min(channel.sample_rate, 127), bands_count_v1))
         await writer.drain()
     except:
         print("Error while sending config to client")
         return
 
     try:
-        await asyncio.wait_for(reader.readexactly(1), timeout=1)
+        response = await asyncio.wait_for(reader.readexactly(1), timeout=1)
+        if response == HELLO_MARKER:
+            hello = await asyncio.wait_for(reader.readexactly(struct.calcsize(HELLO_FMT)), timeout=1)
+        else:
+            hello = None
     except asyncio.TimeoutError:
         print("Timeout while waiting for client response after connection")
         return
+    except asyncio.IncompleteReadError:
+        print("Client disconnected during the handshake")
+        return
+
+    if hello is None:
+        if not bands_count_v1:
+            print(f"Refusing v1 client {writer.get_extra_info('peername')}: {channel.frequency_bands_count} bands, v1 supports up to {MAX_BANDS_V1}. Use protocol v2")
+            writer.close()
+            return
+        client = Client(reader, writer)
+    else:
+        version, flags, encoding_type, frames_per_message = struct.unpack(HELLO_FMT, hello)
+        frames_per_message = min(max(frames_per_message, 1), MAX_FRAMES_PER_MESSAGE)
+        flags &= FLAG_NO_ACK
 
-    print("Client connected")
-    _clients.append([reader, writer])
+        if version != PROTOCOL_V2 or encoding_type not in encoding.ENCODINGS.values():
+            print(f"Unsupported protocol version {version} or encoding {encoding_type}")
+            writer.close()
+            return
 
-async def main(host, port):
-    global _server
-    _server = await asyncio.start_server(handle_client, host, port)
-    broadcast_task = asyncio.create_task(broadcast_fft_data())
-    discard_client_responses_task = asyncio.create_task(discard_client_responses())
-    tasks = asyncio.gather(broadcast_task, discard_client_responses_task)
+        try:
+            config = struct.pack(CONFIG_V2_FMT, PROTOCOL_V2, flags, channel.sample_rate, channel.frequency_bands_count, frames_per_message, encoding_type)
+            if encoding_type in encoding.QUANTIZED_ENCODINGS:
+                config += struct.pack(DB_RANGE_FMT, round(_db_range[0] * 100), round(_db_range[1] * 100))
+            writer.write(config)
+            await writer.drain()
+        except:
+            print("Error while sending config to client")
+            return
+
+        client = Client(reader, writer, PROTOCOL_V2, flags, frames_per_message, encoding_type)
+    client.tasks.append(asyncio.create_task(client_writer(channel, client)))
+    client.tasks.append(asyncio.create_task(client_reader(channel, client)))
+    print(f"Client {client.address} connected to channel {channel.index}. Protocol v{client.version}. Encoding {client.encoding}")
+    channel.clients.append(client)
+
+async def main(host):
+    global _stop_requested
+    _stop_requested = asyncio.Event()
+    if stop_event.is_set():
+        _stop_requested.set()
+
+    tasks = []
+    for channel in _channels:
+        channel.data_queue = asyncio.Queue()
+        channel.server = await asyncio.start_server(functools.partial(handle_client, channel), host, channel.port)
+        if _udp_target is not None:
+            # The UDP config requests are answered on the same port number as the TCP server
+            target = (_udp_target[0], _udp_target[1] + channel.index)
+            channel.udp = await udp_transport.open_channel(host, channel.port, channel.sample_rate, channel.frequency_bands_count, target)
+            print(f"Sending stream {channel.index} over UDP to {target[0]}:{target[1]}")
+        tasks.append(asyncio.create_task(broadcast_fft_data(channel)))
+        tasks.append(asyncio.create_task(report_clients(channel)))
+    tasks = asyncio.gather(*tasks)
     
     ready_event.set()
-    while True:
-        if stop_event.is_set():
-            print("Canceling all tasks")
-            tasks.cancel()
-            try:
-                print("Waiting for tasks to finish")
-                await tasks
-            except asyncio.CancelledError:
-                pass
-            
-            print("Waiting for server to close")
-            _server.close()
-            try:
-                await asyncio.wait_for(_server.wait_closed(), timeout=5)
-            except:
-                pass
+    await _stop_requested.wait()
 
-            asyncio.get_event_loop().stop()
-            break
-        await asyncio.sleep(1)
-        
-def run(asyncio_loop, sample_rate, frequency_bands_count, host, port):
-    global _sample_rate, _frequency_bands_count
-    _sample_rate = sample_rate
-    _frequency_bands_count = frequency_bands_count
+    print("Canceling all tasks")
+    tasks.cancel()
+    try:
+        print("Waiting for tasks to finish")
+        await tasks
+    except asyncio.CancelledError:
+        pass
+    
+    print("Waiting for server to close")
+    for channel in _channels:
+        if channel.udp is not None:
+            channel.udp.close()
+        channel.server.close()
+        try:
+            await asyncio.wait_for(channel.server.wait_closed(), timeout=5)
+        except:
+            pass
 
+    asyncio.get_event_loop().stop()
+        
+def run(asyncio_loop, host):
     asyncio.set_event_loop(asyncio_loop)
     try:
-        asyncio_loop.run_until_complete(main(host, port))
+        asyncio_loop.run_until_complete(main(host))
     finally:
         asyncio_loop.run_until_complete(asyncio_loop.shutdown_asyncgens())
         asyncio_loop.close()
     
-def start(framerate, frequency_bands_count, host, port):
-    global _asyncio_loop, _thread
+def start(framerate, frequency_bands_count, host, port, channels_count = 1, client_lag_budget = None, udp_target = None, db_range = None):
+    '''Serve channels_count FFT streams, stream i is served on port + i.
+    Clients whose writes stay blocked for more than client_lag_budget seconds are disconnected.
+    With a udp_target ("group:port") every frame is also sent once as a datagram, stream i to port + i.
+    db_range is the (min, max) dB range of the quantized encodings'''
+    global _asyncio_loop, _thread, _channels, _client_lag_budget, _udp_target, _db_range
+    if db_range is not None:
+        _db_range = db_range
+    if client_lag_budget is not None:
+        _client_lag_budget = client_lag_budget
+    if udp_target:
+        _udp_target = udp_transport.parse_target(udp_target)
+    _channels = [Channel(i, framerate, frequency_bands_count, port + i) for i in range(channels_count)]
+    if frequency_bands_count > MAX_BANDS_V1:
+        print(f"{frequency_bands_count} frequency bands, only v2 clients can connect (v1 supports up to {MAX_BANDS_V1})")
     loop = asyncio.new_event_loop()
     _asyncio_loop = loop
-    print(f"Started TCP server on {host}:{port}")
-    _thread = threading.Thread(target=run, args=(loop, framerate, frequency_bands_count, host, port))
+    for channel in _channels:
+        print(f"Started TCP server for stream {channel.index} on {host}:{channel.port}")
+    _thread = threading.Thread(target=run, args=(loop, host))
     _thread.start()
 
 def join():
@@ -169,6 +473,11 @@ def join():
 def stop():
     print("Stopping server")
     stop_event.set()
+    if _stop_requested is not None:
+        try:
+            _asyncio_loop.call_soon_threadsafe(_stop_requested.set)
+        except RuntimeError:
+            pass
     print("Waiting for thread to finish")
     _thread.join(10.0)
     
@@ -0,0 +1,98 @@
+import socket
+import struct
+import asyncio
+import ipaddress
+
+MAGIC = b'FT'
+VERSION = 1
+
+MSG_FRAME = 0
+MSG_CONFIG = 1
+MSG_CONFIG_REQUEST = 2
+
+# magic, version, message type
+HEADER_FMT = '!2sBB'
+# header, sequence number, timestamp (seconds since epoch), frequency bands count
+FRAME_HEADER_FMT = HEADER_FMT + 'IdH'
+# header, FFT sample rate, frequency bands count, destination address, destination port
+CONFIG_FMT = HEADER_FMT + 'HH4sH'
+
+HEADER_SIZE = struct.calcsize(HEADER_FMT)
+
+def parse_target(target):
+    '''"group:port" to an (ip, port) tuple'''
+    host, _, port = target.rpartition(':')
+    if not host or not port:
+        raise ValueError(f"Invalid UDP target {target}, expected host:port")
+    return (socket.gethostbyname(host), int(port))
+
+def is_multicast(address):
+    return ipaddress.ip_address(address).is_multicast
+
+class UdpChannel(asyncio.DatagramProtocol):
+    '''Sends the frames of one FFT stream as datagrams to a multicast group or a broadcast
+    address, each frame is sent once no matter how many devices listen.
+
+    The same socket answers config requests so clients can find out the band count
+    and where the frames are sent to'''
+
+    def __init__(self, sample_rate, frequency_bands_count, target):
+        self.sample_rate = sample_rate
+        self.frequency_bands_count = frequency_bands_count
+        self.target = target
+        self.sequence = 0
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if len(data) < HEADER_SIZE:
+            return
+
+        magic, version, message_type = struct.unpack_from(HEADER_FMT, data)
+        if magic != MAGIC or message_type != MSG_CONFIG_REQUEST:
+            return
+
+        self.transport.sendto(self.config_message(), addr)
+
+    def error_received(self, exc):
+        print("UDP error", exc)
+
+    def config_message(self):
+        return struct.pack(CONFIG_FMT, MAGIC, VERSION, MSG_CONFIG,
+                           self.sample_rate, self.frequency_bands_count,
+                           socket.inet_aton(self.target[0]), self.target[1])
+
+    def send(self, payload, timestamp):
+        if self.transport is None or self.transport.is_closing():
+            return
+
+        header = struct.pack(FRAME_HEADER_FMT, MAGIC, VERSION, MSG_FRAME, self.sequence, timestamp, self.frequency_bands_count)
+        self.transport.sendto(header + payload, self.target)
+        self.sequence = (self.sequence + 1) & 0xFFFFFFFF
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+def create_socket(host, port, target):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+    if is_multicast(target[0]):
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+    else:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+
+    sock.bind((host, port))
+    sock.setblocking(False)
+    return sock
+
+async def open_channel(host, port, sample_rate, frequency_bands_count, target):
+    '''Bind the config socket on host:port (UDP) and send the frames to target'''
+    loop = asyncio.get_running_loop()
+    sock = create_socket(host, port, target)
+    _, channel = await loop.create_datagram_endpoint(lambda: UdpChannel(sample_rate, frequency_bands_count, target), sock=sock)
+    return channel
@@ -0,0 +1,71 @@
+'''WAV files mapped in memory, the samples are read straight from the page cache'''
+
+import os
+import struct
+import numpy as np
+from . import fft
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+# audio format, channels, framerate, byte rate, block align, bits per sample
+_FMT_FMT = '<HHIIHH'
+
+class WavFile:
+    '''Parses the RIFF chunks once and maps the data chunk as a read-only
+    (frames, channels) array, slicing it never copies any sample'''
+
+    def __init__(self, path):
+        self.path = path
+        fmt = None
+        data_offset = data_size = None
+        file_size = os.path.getsize(path)
+
+        with open(path, 'rb') as f:
+            riff, _, wave = struct.unpack('<4sI4s', f.read(12))
+            if riff != b'RIFF' or wave != b'WAVE':
+                raise ValueError(f"{path} is not a WAV file")
+
+            while data_offset is None:
+                header = f.read(8)
+                if len(header) < 8:
+                    break
+
+                chunk_id, chunk_size = struct.unpack('<4sI', header)
+                if chunk_id == b'fmt ':
+                    fmt = struct.unpack(_FMT_FMT, f.read(struct.calcsize(_FMT_FMT)))
+                    f.seek(chunk_size - struct.calcsize(_FMT_FMT), os.SEEK_CUR)
+                elif chunk_id == b'data':
+                    data_offset = f.tell()
+                    # Streamed/truncated files can declare more data than there is
+                    data_size = min(chunk_size, file_size - data_offset)
+                else:
+                    f.seek(chunk_size, os.SEEK_CUR)
+
+                # Chunks are word aligned
+                if chunk_size % 2 and data_offset is None:
+                    f.seek(1, os.SEEK_CUR)
+
+        if fmt is None or data_offset is None:
+            raise ValueError(f"{path} has no fmt or data chunk")
+
+        audio_format, self.channels, self.framerate, _, block_align, bits = fmt
+        self.sample_width = bits // 8
+        if audio_format not in (WAVE_FORMAT_PCM, WAVE_FORMAT_EXTENSIBLE) or self.sample_width not in (1, 2):
+            raise ValueError(f"{path}: only 8 and 16 bit PCM is supported")
+
+        self.frames_count = data_size // block_align
+        dtype = fft.sample_dtype(self.sample_width)
+        if self.frames_count:
+            self.samples = np.memmap(path, dtype=dtype, mode='r', offset=data_offset, shape=(self.frames_count, self.channels))
+        else:
+            # Empty files can't be mapped
+            self.samples = np.empty((0, self.channels), dtype=dtype)
+
+    def blocks(self, size, start = 0):
+        '''Views of `size` frames (the last one can be shorter)'''
+        for offset in range(start, self.frames_count, size):
+            yield self.samples[offset:offset + size]
+
+    def close(self):
+        self.samples = None